@@ -1,10 +1,18 @@
+import base64
 from datetime import datetime, timedelta, timezone
+import hashlib
+import hmac
+import json
 import os
+import time
 from typing import Optional
 
+from cachetools import TLRUCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
+from jose import JWTError
+from jose.exceptions import ExpiredSignatureError
+from pydantic import ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from . import crud, schemas
@@ -18,6 +26,9 @@ from .database import get_db
 # 本番環境では必ず環境変数で設定すること（例: SECRET_KEY=your-very-secure-random-string）
 SECRET_KEY = os.getenv("SECRET_KEY", "CHANGE_ME")
 
+# 署名・検証に使う鍵のバイト列（起動時に一度だけエンコードし、リクエストごとの変換を省く）
+_SECRET_KEY_BYTES = SECRET_KEY.encode("utf-8")
+
 # JWTの署名アルゴリズム（HS256 = HMAC-SHA256）
 ALGORITHM = "HS256"
 
@@ -28,6 +39,52 @@ ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60")
 # tokenUrl: トークンを取得するエンドポイントのURL
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+# ----------------------------------------------------------------------
+# デコード済みトークンのキャッシュ
+# ----------------------------------------------------------------------
+
+# 同じBearerトークンは有効期限内に何度も送られてくるため、検証結果（メールアドレス）をプロセス内にキャッシュし、
+# リクエストごとの jwt.decode（HMAC-SHA256の計算 + JSONパース）を省略します。
+# キャッシュの保持期間は「トークンの残り有効期間 - TOKEN_CACHE_EXPIRY_MARGIN_SECONDS」と TOKEN_CACHE_MAX_TTL_SECONDS の短い方です。
+# 有効期限ぎりぎりのトークンはキャッシュから返さず、毎回署名と有効期限を検証し直します。
+TOKEN_CACHE_MAX_TTL_SECONDS = 300
+TOKEN_CACHE_EXPIRY_MARGIN_SECONDS = 5
+
+
+def _token_cache_ttu(_key: bytes, value: tuple[str, float, Optional[schemas.UserOut]], now: float) -> float:
+    """キャッシュエントリの有効期限（TLRUCacheのタイマー基準）を計算する"""
+    _, exp, _ = value
+    return now + min(exp - time.time() - TOKEN_CACHE_EXPIRY_MARGIN_SECONDS, TOKEN_CACHE_MAX_TTL_SECONDS)
+
+
+# キー: トークンのSHA-256ダイジェスト（トークン文字列そのものはメモリに保持しない）
+# 値: (メールアドレス, 有効期限のUNIX時刻, トークンのクレームから組み立てたユーザー情報（uid を含まない古いトークンでは None）)
+_token_cache: TLRUCache = TLRUCache(maxsize=10000, ttu=_token_cache_ttu)
+
+
+def _b64url_encode(data: bytes) -> str:
+    """バイト列を、JWTで使われるパディングなしの Base64URL 文字列にエンコードする"""
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+# JWTのヘッダー部分（header.payload.signature の header）は常に同じなので、起動時に一度だけエンコードしておく
+_JWT_HEADER_SEGMENT = _b64url_encode(
+    json.dumps({"alg": ALGORITHM, "typ": "JWT"}, separators=(",", ":")).encode("utf-8")
+)
+
+
+def _sign_hs256(payload: dict, key: bytes) -> str:
+    """
+    ペイロードを HS256 で署名し、JWT文字列を生成する内部関数
+
+    python-jose の jwt.encode の代わりに、_verify_hs256 と同じく標準ライブラリの hmac / hashlib で署名します。
+    （jwt.encode は呼び出しのたびにヘッダーの組み立てと鍵オブジェクトの作成を行うため）
+    """
+    payload_segment = _b64url_encode(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+    signing_input = f"{_JWT_HEADER_SEGMENT}.{payload_segment}"
+    signature = hmac.new(key, signing_input.encode("ascii"), hashlib.sha256).digest()
+    return f"{signing_input}.{_b64url_encode(signature)}"
+
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """
@@ -35,6 +92,8 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     
     Args:
         data: トークンに含めるデータ（通常は {"sub": "user@example.com"} のようなユーザー識別情報）
+              "uid"（ユーザーID）と "created_at"（登録日時のISO 8601文字列）も含めておくと、
+              get_current_user がDBを検索せずにトークンだけからユーザー情報を組み立てられます
         expires_delta: トークンの有効期限（省略時はデフォルト値を使用）
     
     Returns:
@@ -47,29 +106,114 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     # expires_deltaが指定されていればそれを使用、なければデフォルト値（ACCESS_TOKEN_EXPIRE_MINUTES分）
     expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     
-    # トークンに有効期限（"exp" クレーム）を追加
-    to_encode.update({"exp": expire})
+    # トークンに有効期限（"exp" クレーム、UNIX時刻の整数）を追加
+    to_encode.update({"exp": int(expire.timestamp())})
     
     # SECRET_KEYで署名してJWT文字列を生成
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return _sign_hs256(to_encode, _SECRET_KEY_BYTES)
 
 
-def _decode_token(token: str) -> str:
+def _b64url_decode(segment: str) -> bytes:
+    """JWTで使われるパディングなしの Base64URL 文字列をデコードする（不正な文字を含む場合は ValueError）"""
+    return base64.b64decode(segment + "=" * (-len(segment) % 4), altchars=b"-_", validate=True)
+
+
+def _verify_hs256(token: str, key: bytes) -> dict:
     """
-    JWTトークンを検証して、中に含まれるユーザーのメールアドレス（sub）を取得する内部関数
+    HS256 で署名されたJWTを検証し、ペイロード（クレーム）を返す内部関数
+
+    python-jose の jwt.decode の代わりに、標準ライブラリの hmac / hashlib で署名を検証します。
+    hashlib は OpenSSL の SHA-256 実装（対応CPUではSHA拡張命令）を使うため高速です。
+    改ざんされたトークンのJSONを解析しないよう、署名を確認してからヘッダーとペイロードをパースします。
+
+    Args:
+        token: 検証するJWTトークン文字列（header.payload.signature）
+        key: 署名の検証に使う秘密鍵
+
+    Returns:
+        デコードされたペイロード
+
+    Raises:
+        JWTError: 形式が不正、署名が一致しない、アルゴリズムがHS256でない、expが無い場合
+        ExpiredSignatureError: 有効期限（exp）を過ぎている場合（JWTErrorのサブクラス）
+    """
+    try:
+        signing_input, _, signature_segment = token.rpartition(".")
+        header_segment, _, payload_segment = signing_input.partition(".")
+        if not header_segment or not payload_segment or "." in payload_segment:
+            raise JWTError("Not enough segments")
+
+        # 1. 署名の検証（比較は処理時間から情報が漏れないよう compare_digest で行う）
+        signature = _b64url_decode(signature_segment)
+        expected = hmac.new(key, signing_input.encode("ascii"), hashlib.sha256).digest()
+        if not hmac.compare_digest(signature, expected):
+            raise JWTError("Signature verification failed")
+
+        # 2. 署名が正しい場合のみ、ヘッダーとペイロードをパースする
+        header = json.loads(_b64url_decode(header_segment))
+        payload = json.loads(_b64url_decode(payload_segment))
+    except ValueError as exc:
+        # Base64 / ASCII / JSON の形式エラー（binascii.Error, UnicodeError, JSONDecodeError を含む）
+        raise JWTError("Invalid token") from exc
+
+    if not isinstance(header, dict) or header.get("alg") != ALGORITHM:
+        raise JWTError("The specified alg value is not allowed")
+    if not isinstance(payload, dict):
+        raise JWTError("Invalid payload")
+
+    # 3. 有効期限（exp）と有効開始時刻（nbf）の確認
+    now = time.time()
+    exp = payload.get("exp")
+    if isinstance(exp, bool) or not isinstance(exp, (int, float)):
+        raise JWTError("Missing or invalid exp claim")
+    if exp <= now:
+        raise ExpiredSignatureError("Signature has expired.")
+    nbf = payload.get("nbf")
+    if nbf is not None and (not isinstance(nbf, (int, float)) or nbf > now):
+        raise JWTError("The token is not yet valid (nbf)")
+
+    return payload
+
+
+def _user_from_claims(payload: dict) -> Optional[schemas.UserOut]:
+    """
+    トークンのクレーム（sub / uid / created_at）からユーザー情報を組み立てる内部関数
+
+    これらはログイン時に認証済みのユーザー情報から発行され、署名で改ざんされていないことが確認できるため、
+    DBを検索し直す必要はありません。uid を含まない（このバージョンより前に発行された）トークンでは None を返します。
+    """
+    uid = payload.get("uid")
+    created_at = payload.get("created_at")
+    if uid is None or created_at is None:
+        return None
+    try:
+        return schemas.UserOut(id=uid, email=payload["sub"], created_at=created_at)
+    except ValidationError as exc:
+        raise JWTError("Invalid user claims") from exc
+
+
+def _verify_token(token: str) -> tuple[str, Optional[schemas.UserOut]]:
+    """
+    JWTトークンを検証して、メールアドレス（sub）と、クレームから組み立てたユーザー情報を取得する内部関数
     
     Args:
         token: 検証するJWTトークン文字列
     
     Returns:
-        トークンに含まれるメールアドレス（subクレームの値）
+        (メールアドレス, ユーザー情報) のタプル（ユーザー情報はトークンに uid が含まれない場合 None）
     
     Raises:
         JWTError: トークンが無効、期限切れ、または署名が正しくない場合
     """
+    # キャッシュに検証済みの結果があれば、署名の再検証をスキップして返す
+    key = hashlib.sha256(token.encode()).digest()
+    cached = _token_cache.get(key)
+    if cached is not None:
+        return cached[0], cached[2]
+
     try:
         # トークンをデコードして検証（署名の確認と有効期限のチェックも行う）
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = _verify_hs256(token, _SECRET_KEY_BYTES)
         
         # ペイロードからユーザー識別子（sub = subject）を取得
         email: str | None = payload.get("sub")
@@ -77,17 +221,50 @@ def _decode_token(token: str) -> str:
         # subが存在しない場合はエラー
         if email is None:
             raise JWTError("Missing subject")
-        
-        return email
+
+        user_out = _user_from_claims(payload)
     except JWTError as exc:
         # JWTエラー（無効なトークン、期限切れなど）をそのまま再発生させる
         # 呼び出し側で統一的にエラーハンドリングできるようにする
+        # 失敗した結果はキャッシュしない
         raise exc
 
+    # 検証に成功した結果のみキャッシュする
+    _token_cache[key] = (email, float(payload["exp"]), user_out)
+
+    return email, user_out
+
+
+def _decode_token(token: str) -> str:
+    """
+    JWTトークンを検証して、中に含まれるユーザーのメールアドレス（sub）を取得する内部関数
+
+    Raises:
+        JWTError: トークンが無効、期限切れ、または署名が正しくない場合
+    """
+    return _verify_token(token)[0]
+
+
+# 認証に失敗した場合に返す共通のエラーレスポンスの内容
+# 認証に成功するリクエスト（大多数）で毎回例外オブジェクトを作らないよう、内容だけを定数として持ち、
+# 例外は失敗したときにだけ _credentials_exception() で生成します。
+# （同じ例外インスタンスを使い回すと、送出のたびにトレースバックが積み重なるため共有はしない）
+_CREDENTIALS_DETAIL = "認証情報を検証できませんでした"  # 認証情報が無効であることを示すメッセージ
+_CREDENTIALS_HEADERS = {"WWW-Authenticate": "Bearer"}  # クライアントにBearer認証が必要であることを通知
+
+
+def _credentials_exception() -> HTTPException:
+    """認証失敗時に送出する 401 Unauthorized の例外を生成する"""
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,  # 401 Unauthorized
+        detail=_CREDENTIALS_DETAIL,
+        headers=_CREDENTIALS_HEADERS,
+    )
+
 
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_db, scope="function"),
 ) -> schemas.UserOut:
     """
     リクエストに含まれるJWTトークンから現在ログインしているユーザーを取得する依存関数
@@ -105,28 +282,26 @@ async def get_current_user(
     Raises:
         HTTPException: トークンが無効、またはユーザーが見つからない場合（401 Unauthorized）
     """
-    # 認証に失敗した場合に返す共通のエラーレスポンス
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,  # 401 Unauthorized
-        detail="認証情報を検証できませんでした",  # 認証情報が無効であることを示すメッセージ
-        headers={"WWW-Authenticate": "Bearer"},  # クライアントにBearer認証が必要であることを通知
-    )
-    
     try:
-        # JWTトークンを検証して、中に含まれるメールアドレスを取得
-        email = _decode_token(token)
-        # TokenDataスキーマにメールアドレスを格納
-        token_data = schemas.TokenData(email=email)
+        # JWTトークンを検証して、中に含まれるメールアドレスとユーザー情報を取得
+        email, user_out = _verify_token(token)
     except JWTError:
         # トークンが無効、期限切れ、または署名が正しくない場合は認証エラー
-        raise credentials_exception
+        raise _credentials_exception()
+
+    # トークンにユーザー情報（uid など）が含まれていれば、DBを検索せずにそのまま返す
+    # （ルーターで使うのは current_user.id のみで、これはユーザーが存在する限り変わらない）
+    if user_out is not None:
+        return user_out
 
-    # トークンから取得したメールアドレスでデータベースからユーザーを検索
-    user = await crud.get_user_by_email(db, email=token_data.email) if token_data.email else None
+    # uid を含まない古いトークン（クレームにユーザー情報を含める前に発行されたもの）は、DBからユーザーを検索する
+    # このようなトークンはリリースから ACCESS_TOKEN_EXPIRE_MINUTES（既定60分）以内にすべて期限切れになるため、
+    # キャッシュは設けない（期限切れ後はここに到達しない）
+    user = await crud.get_user_by_email(db, email=email)
     
     # ユーザーが見つからない場合も認証エラー
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
     
     # データベースのモデル（models.User）をAPIレスポンス用のスキーマ（schemas.UserOut）に変換して返す
     return schemas.UserOut.model_validate(user)
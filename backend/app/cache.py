@@ -0,0 +1,88 @@
+import logging
+import os
+from typing import Optional
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# ----------------------------------------------------------------------
+# Redis キャッシュの設定
+# ----------------------------------------------------------------------
+# 複数のワーカープロセス・コンテナで共有するキャッシュとして Redis を使用します。
+#
+# - 環境変数 REDIS_URL（例: redis://redis:6379/0）が設定されていない場合、キャッシュは無効になり、
+#   cache_get は常に None（キャッシュミス）を返します。（テストやRedisなしの開発環境向け）
+# - Redis が停止・応答しない場合もエラーにはせず、ログを出してキャッシュミスとして扱います。
+#   （キャッシュはあくまで高速化のためのもので、DBが正しいデータの置き場所であるため）
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Redis に繋がらないときにリクエストが長時間待たされないよう、タイムアウトは短めにする
+redis_client: Optional[redis.Redis] = (
+    redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    if REDIS_URL
+    else None
+)
+
+
+async def cache_get(key: str) -> Optional[bytes]:
+    """キャッシュから値を取得する（無効・未登録・Redis障害時は None）"""
+    if redis_client is None:
+        return None
+    try:
+        return await redis_client.get(key)
+    except RedisError as e:
+        logger.warning(f"Redisからの読み込みに失敗しました（DBにフォールバックします）: {e}")
+        return None
+
+
+async def cache_set(key: str, value: bytes | str, ttl_seconds: int) -> None:
+    """キャッシュに有効期限付きで値を保存する（無効・Redis障害時は何もしない）"""
+    if redis_client is None:
+        return
+    try:
+        await redis_client.set(key, value, ex=ttl_seconds)
+    except RedisError as e:
+        logger.warning(f"Redisへの書き込みに失敗しました: {e}")
+
+
+async def cache_delete(*keys: str) -> None:
+    """キャッシュから値を削除する（無効・Redis障害時は何もしない）"""
+    if redis_client is None or not keys:
+        return
+    try:
+        await redis_client.delete(*keys)
+    except RedisError as e:
+        logger.warning(f"Redisのキャッシュ削除に失敗しました: {e}")
+
+
+# コミット後に削除するキャッシュのキーを、セッションの info に一時的に保存するときのキー
+_PENDING_DELETES = "cache_pending_deletes"
+
+
+def cache_delete_after_commit(db: AsyncSession, *keys: str) -> None:
+    """
+    トランザクションのコミット後にキャッシュを削除するよう予約する
+
+    データを書き換えるリクエストでは、コミットはハンドラーが返った後（get_db の終了時）に行われます。
+    コミット前にキャッシュを削除すると、その間に届いた読み込みがコミット前の古いデータを
+    キャッシュに書き戻してしまうため、削除はコミットの後に run_pending_cache_deletes で行います。
+    （ロールバックされた場合は何も削除しません）
+    """
+    db.info.setdefault(_PENDING_DELETES, set()).update(keys)
+
+
+async def run_pending_cache_deletes(db: AsyncSession) -> None:
+    """cache_delete_after_commit で予約したキャッシュを削除する（コミットの後に呼び出すこと）"""
+    keys = db.info.pop(_PENDING_DELETES, None)
+    if keys:
+        await cache_delete(*keys)
+
+
+async def close_cache() -> None:
+    """アプリケーション終了時に Redis の接続プールを閉じる"""
+    if redis_client is not None:
+        await redis_client.aclose()
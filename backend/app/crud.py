@@ -1,155 +1,302 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, delete
+from sqlalchemy.orm import defer
+from sqlalchemy import Integer, Row, case, column, delete, select, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 # IntegrityError をインポートに追加
 from sqlalchemy.exc import IntegrityError 
 from typing import Optional
 from fastapi import HTTPException
 from . import models, schemas
 from passlib.context import CryptContext
-# PostgreSQLのエラーコードを取得するためにインポート (環境に応じて変更が必要)
-import asyncpg.exceptions 
+
+logger = logging.getLogger(__name__)
 
 # ----------------------------------------------------------------------
 # パスワードハッシュ化の設定
 # ----------------------------------------------------------------------
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt のコスト（rounds）は1増えるごとに計算時間が2倍になります。
+# passlib のデフォルト（12）では1回の検証に数百ミリ秒かかるため、OWASP推奨の下限である 10 を既定値にします。
+# テストではハッシュの強度は不要なため、環境変数 BCRYPT_ROUNDS=4（bcrypt の最小値）で計算を省きます。
+# また、ハッシュ化・検証はCPUを占有する同期処理なので、専用のスレッドプールに逃がし、
+# イベントループ（他のリクエストの処理）を止めないようにします（呼び出しは run_password_hasher 経由で行うこと）。
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt のバックエンド（ライブラリの検出と自己テスト）は最初のハッシュ化・検証のときに読み込まれ、
+# 数十ミリ秒かかります。最初のリクエストでこの遅延が発生しないよう、インポート時に読み込んでおきます。
+try:
+    pwd_context.handler("bcrypt").get_backend()
+except Exception as e:
+    # 読み込みに失敗してもアプリの起動は止めない（実際のハッシュ化時に改めてエラーになる）
+    logger.warning(f"bcryptバックエンドの事前読み込みに失敗しました: {e}")
+
+# パスワードのハッシュ化・検証専用のスレッドプール
+# bcrypt は計算中にGILを解放するため、CPUコア数までは並列に実行できます。
+# asyncio.to_thread の共有スレッドプールを使うと、ログインが集中したときに他の処理のスレッドまで埋めてしまうため、
+# 同時実行数をCPUコア数に制限した専用のプールを使います。
+_password_hash_executor = ThreadPoolExecutor(
+    max_workers=os.cpu_count() or 1,
+    thread_name_prefix="password-hash",
+)
+
+
+def hash_password(password: str) -> str:
+    """パスワードをハッシュ化する（同期処理。run_password_hasher 経由で呼び出すこと）"""
+    return pwd_context.hash(password)
+
+
+def verify_password(password: str, hashed_password: str) -> bool:
+    """パスワードとハッシュ値を照合する（同期処理。run_password_hasher 経由で呼び出すこと）"""
+    return pwd_context.verify(password, hashed_password)
+
+
+async def run_password_hasher(func, *args):
+    """hash_password / verify_password を専用スレッドプールで実行し、結果を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_hash_executor, func, *args)
+
+# 登録済みと分かったメールアドレスの記録（重複登録を DB に問い合わせずに 400 で返すため）
+# - ユーザーは削除されないため、一度登録済みと分かったメールアドレスは登録済みのまま変わらない
+# - 記録するのは ON CONFLICT で重複と判定されたもの（= 他のトランザクションでコミット済み）だけ。
+#   INSERT に成功した直後はまだコミット前で、コミットに失敗するとユーザーが存在しないまま記録が残るため記録しない
+# - 件数は RECENT_EMAILS_MAXSIZE 件までとし、超えたら古いものから捨てる（FIFO）
+# 確認から記録までの間に await を挟まないため、ロックは不要です
+RECENT_EMAILS_MAXSIZE = 10000
+_recent_emails: OrderedDict[str, None] = OrderedDict()
+
+
+def _remember_registered_email(email: str) -> None:
+    """登録済みのメールアドレスを記録する（上限を超えたら古いものから捨てる）"""
+    _recent_emails[email] = None
+    if len(_recent_emails) > RECENT_EMAILS_MAXSIZE:
+        _recent_emails.popitem(last=False)
+
+# ----------------------------------------------------------------------
+# エラーコード
+# ----------------------------------------------------------------------
+# エラーの種類を、表示用の文言（detail、日本語）に依存せずに判定できるよう、
+# レスポンスヘッダー X-Error-Code で機械向けのコードを返します。
+ERROR_CODE_HEADER = "X-Error-Code"
+EMAIL_EXISTS = "EMAIL_EXISTS"  # メールアドレスが既に登録されている
 
 # ----------------------------------------------------------------------
 # ユーザー関連の CRUD
 # ----------------------------------------------------------------------
 
 async def get_user_by_email(db: AsyncSession, email: str) -> Optional[models.User]:
-    """メールアドレスでユーザーを検索する関数"""
+    """
+    メールアドレスでユーザーを検索する関数
+
+    パスワードのハッシュ値（hashed_password）は読み込みません。
+    ハッシュ値が必要なログイン処理では get_user_with_password を使用してください。
+    （認証済みリクエストでは通常トークンのクレームからユーザー情報を組み立てるため、
+      これが呼ばれるのは uid を含まない古いトークンの場合だけです。auth.get_current_user を参照）
+    """
+    result = await db.execute(
+        select(models.User)
+        .options(defer(models.User.hashed_password))
+        .where(models.User.email == email)
+    )
+    return result.scalar_one_or_none()
+
+async def get_user_with_password(db: AsyncSession, email: str) -> Optional[models.User]:
+    """
+    パスワードのハッシュ値を含めてユーザーを取得する関数（ログイン時の認証専用）
+
+    パスワード変更などが即座に反映されるよう、キャッシュは使わずに毎回DBから取得します。
+    """
     result = await db.execute(select(models.User).where(models.User.email == email))
     return result.scalar_one_or_none()
 
-async def create_user(db: AsyncSession, user: schemas.UserCreate) -> models.User:
+async def create_user(db: AsyncSession, user: schemas.UserCreate) -> Row:
     """
     新しいユーザーを作成する関数
-    - 重複登録時には 409 Conflict を返すように修正済み
+    - メールアドレスが既に登録されている場合は 400 Bad Request を返す
+    - 戻り値はレスポンス（schemas.UserOut）に必要なカラム（id, email, created_at）だけの Row
+
+    「存在確認の SELECT → INSERT」の2回に分けると、DBとの往復が2回になるうえ、
+    同時に同じメールアドレスで登録された場合に確認と登録の間で競合（TOCTOU）が起きます。
+    そのため INSERT ... ON CONFLICT (email) DO NOTHING RETURNING * の1文で
+    重複チェックと登録を同時に行い、行が返ってこなければ重複とみなします。
+    以前に重複と判定したメールアドレス（_recent_emails）は、ハッシュ化やDBへの問い合わせをせずに 400 を返します。
     """
+    if user.email in _recent_emails:
+        raise _email_exists_error()
+
     try:
         # 1. パスワードをbcryptでハッシュ化
-        hashed_password = pwd_context.hash(user.password)
+        hashed_password = await run_password_hasher(hash_password, user.password)
     except ValueError as e:
         # パスワードのハッシュ化エラー
         raise HTTPException(status_code=400, detail=str(e))
     
-    # 2. ユーザーモデルのインスタンスを作成
-    db_user = models.User(email=user.email, hashed_password=hashed_password)
-    
-    # 3. セッションに追加（INSERT操作）
-    db.add(db_user)
-    
-    # 4. データベースにコミット（重複エラーをここで捕捉）
+    # 2. INSERT ... ON CONFLICT 文を作成
+    #    ON CONFLICT は方言ごとの insert() で組み立てる必要があるため、接続先に合わせて選ぶ
+    #    （本番は PostgreSQL、テストは SQLite）
+    #    作成したユーザーはレスポンスを返すだけで変更しないため、ORMオブジェクト（models.User）は作らず、
+    #    テーブルに対する Core の INSERT で必要なカラムだけを返す（アイデンティティマップへの登録などを省く）
+    dialect_insert = sqlite_insert if db.get_bind().dialect.name == "sqlite" else pg_insert
+    users = models.User.__table__
+    stmt = (
+        dialect_insert(users)
+        .values(email=user.email, hashed_password=hashed_password)
+        .on_conflict_do_nothing(index_elements=[users.c.email])
+        .returning(users.c.id, users.c.email, users.c.created_at)
+    )
+
+    # 3. INSERT をデータベースに送信
+    #    コミットはリクエストの終わりに get_db でまとめて行われ、
+    #    ここで例外を送出した場合はトランザクション全体がロールバックされます
+    #    RETURNING により採番されたIDや既定値も同時に取得できるため、再読み込み（refresh）は不要です
     try:
-        await db.commit()
-    
-    except IntegrityError as e:
-        # コミット失敗時はロールバック
-        await db.rollback()
-        
-        # PostgreSQLのUniqueViolationエラーを判定
-        if isinstance(e.orig, asyncpg.exceptions.UniqueViolationError) or 'duplicate key value violates unique constraint' in str(e):
-             # UNIQUE制約違反の場合 (メールアドレス重複)
-             # HTTP 409 Conflict を使用
-             raise HTTPException(
-                 status_code=409, 
-                 detail="このメールアドレスは既に登録されています。"
-             )
-        else:
-             # その他の IntegrityError
-             raise HTTPException(
-                 status_code=500, 
-                 detail="データベース制約エラーが発生しました。"
-             )
-    
-    # 5. データベースから最新の情報を再読み込み
-    await db.refresh(db_user)
-    
+        result = await db.execute(stmt)
+    except IntegrityError:
+        # メールアドレスの重複以外の制約違反
+        raise HTTPException(
+            status_code=500, 
+            detail="データベース制約エラーが発生しました。"
+        )
+
+    db_user = result.one_or_none()
+    if db_user is None:
+        # ON CONFLICT で INSERT されなかった = メールアドレスが既に登録されている
+        _remember_registered_email(user.email)
+        raise _email_exists_error()
     return db_user
 
+def _email_exists_error() -> HTTPException:
+    """メールアドレスが既に登録されている場合のエラー"""
+    # detail（表示用の文言）とは別に、クライアントが判定に使うエラーコードをヘッダーで返す
+    return HTTPException(
+        status_code=400,
+        detail="このメールアドレスは既に登録されています",
+        headers={ERROR_CODE_HEADER: EMAIL_EXISTS},
+    )
+
 async def authenticate_user(db: AsyncSession, email: str, password: str) -> Optional[models.User]:
     """ユーザーの認証を行う関数"""
-    user = await get_user_by_email(db, email=email)
+    user = await get_user_with_password(db, email=email)
     if not user:
         return None
-    if not pwd_context.verify(password, user.hashed_password):
+    if not await run_password_hasher(verify_password, password, user.hashed_password):
         return None
     return user
 
 # ----------------------------------------------------------------------
-# To Do 関連の CRUD (変更なし)
+# To Do 関連の CRUD
 # ----------------------------------------------------------------------
 
-async def get_todos(db: AsyncSession, owner_id: int) -> list[models.Todo]:
-    """データベースから全ての Todo アイテムを取得します。"""
+async def get_todos(db: AsyncSession, owner_id: int) -> list[Row]:
+    """
+    データベースから全ての Todo アイテムを取得します。
+
+    一覧表示は読み取り専用なので、ORMオブジェクト（models.Todo）は作らず、
+    レスポンス（schemas.TodoOut）に必要なカラムだけを軽量な Row として返します。
+    （アイデンティティマップへの登録や属性の監視が不要になり、件数が多いほど速くなります）
+    """
     result = await db.execute(
-        select(models.Todo).where(models.Todo.owner_id == owner_id).order_by(models.Todo.order)
+        select(
+            models.Todo.id,
+            models.Todo.title,
+            models.Todo.description,
+            models.Todo.completed,
+            models.Todo.order,
+            models.Todo.created_at,
+            models.Todo.updated_at,
+            models.Todo.owner_id,
+        )
+        .where(models.Todo.owner_id == owner_id)
+        .order_by(models.Todo.order)
     )
-    return result.scalars().all()
+    return result.all()
 
 async def create_todo(db: AsyncSession, todo: schemas.TodoCreate, owner_id: int) -> models.Todo:
-    """新しい Todo アイテムを作成し、DB にコミットします。"""
+    """新しい Todo アイテムを作成します（コミットはリクエストの終わりに get_db で行われます）。"""
     new_todo = models.Todo(**todo.model_dump(), owner_id=owner_id) 
     db.add(new_todo)
-    await db.commit()
-    await db.refresh(new_todo)
+    # INSERT を送信して、採番されたIDや既定値を new_todo に反映させる
+    await db.flush()
     return new_todo
 
 async def update_todo(db: AsyncSession, todo_id: int, todo: schemas.TodoUpdate, owner_id: int) -> Optional[models.Todo]:
     """指定された ID の Todo アイテムを更新します。"""
+    update_data = todo.model_dump(exclude_unset=True)
+
+    # 更新するフィールドがない場合は、現在の値をそのまま返す
+    if not update_data:
+        return await get_todo_by_id(db, todo_id=todo_id, owner_id=owner_id)
+
+    # SELECT してから UPDATE すると往復が2回になるため、
+    # UPDATE ... WHERE id = ? AND owner_id = ? RETURNING * の1文で更新と取得を同時に行う
     result = await db.execute(
-        select(models.Todo).where(models.Todo.id == todo_id, models.Todo.owner_id == owner_id)
+        update(models.Todo)
+        .where(models.Todo.id == todo_id, models.Todo.owner_id == owner_id)
+        .values(**update_data)
+        .returning(models.Todo)
     )
-    db_todo = result.scalar_one_or_none()
-    
-    if db_todo:
-        update_data = todo.model_dump(exclude_unset=True) 
-        for key, value in update_data.items():
-            setattr(db_todo, key, value)
-            
-        await db.commit()
-        await db.refresh(db_todo)
-        
-    return db_todo
+    return result.scalar_one_or_none()
 
 async def delete_todo(db: AsyncSession, todo_id: int, owner_id: int) -> Optional[models.Todo]:
     """指定された ID の Todo アイテムを削除します。"""
+    # DELETE ... RETURNING * の1文で削除し、削除した行を返す（対象がなければ None）
     result = await db.execute(
-        select(models.Todo).where(models.Todo.id == todo_id, models.Todo.owner_id == owner_id)
+        delete(models.Todo)
+        .where(models.Todo.id == todo_id, models.Todo.owner_id == owner_id)
+        .returning(models.Todo)
     )
-    db_todo = result.scalar_one_or_none()
-    
-    if db_todo:
-        await db.delete(db_todo)
-        await db.commit()
-        
-    return db_todo
+    return result.scalar_one_or_none()
 
 async def get_todo_by_id(db: AsyncSession, todo_id: int, owner_id: int) -> Optional[models.Todo]:
     """指定された ID の Todo アイテムを単体で取得します。"""
-    return result.scalar_one_or_none()
+    # 主キーでの取得は session.get() を使う
+    # （同じセッション内で取得済みならアイデンティティマップから返され、DBへの問い合わせが発生しない）
+    db_todo = await db.get(models.Todo, todo_id)
+    # 所有者の確認は、取得後にPython側で行う
+    if db_todo is None or db_todo.owner_id != owner_id:
+        return None
+    return db_todo
 
 async def reorder_todos(db: AsyncSession, todo_ids: list[int], owner_id: int):
     """
     Todoのリスト順序を一括更新する
     受け取ったIDリストの順番通りに order カラムを更新
     """
-    # ユーザーのTodoだけ対象にするため、一度所有権を確認するのが望ましいが
-    # ここでは簡易的にリスト内のIDがユーザーのものであると仮定して更新、
-    # もしくは個別にUPDATEを実行する単純なループで実装
-    for index, t_id in enumerate(todo_ids):
-        # 効率化のためバルク更新が望ましいが、非同期ORMでの単純な実装としてループ処理
+    if not todo_ids:
+        return
+
+    # 1件ずつ SELECT + UPDATE するとDBとの往復がID数に比例して増えるため、1回の UPDATE 文でまとめて更新する
+    # owner_id で絞り込むため、他のユーザーのTodoのIDが含まれていても更新されない
+    if db.get_bind().dialect.name == "sqlite":
+        # SQLite は VALUES にカラム名を付けられない（AS v(id, pos) が書けない）ため、CASE式で更新する
+        #   UPDATE todos SET "order" = CASE id WHEN :id1 THEN 0 WHEN :id2 THEN 1 ... END
+        #   WHERE owner_id = :owner_id AND id IN (...)
+        new_order = case(
+            {t_id: index for index, t_id in enumerate(todo_ids)},
+            value=models.Todo.id,
+        )
         stmt = (
-            select(models.Todo)
-            .where(models.Todo.id == t_id)
-            .where(models.Todo.owner_id == owner_id)
+            update(models.Todo)
+            .where(models.Todo.owner_id == owner_id, models.Todo.id.in_(todo_ids))
+            .values(order=new_order)
         )
-        result = await db.execute(stmt)
-        todo = result.scalar_one_or_none()
-        if todo:
-            todo.order = index
-            db.add(todo)
-    
-    await db.commit()
\ No newline at end of file
+    else:
+        # PostgreSQL では (id, 新しい順番) の組を VALUES で渡して結合する
+        # （CASE式は行ごとに WHEN を先頭から比較するため、件数が多いとこちらの方が速い）
+        #   UPDATE todos SET "order" = v.pos FROM (VALUES (:id1, 0), (:id2, 1), ...) AS v (id, pos)
+        #   WHERE todos.id = v.id AND todos.owner_id = :owner_id
+        new_orders = values(
+            column("id", Integer), column("pos", Integer), name="v"
+        ).data([(t_id, index) for index, t_id in enumerate(todo_ids)])
+        stmt = (
+            update(models.Todo)
+            .where(models.Todo.id == new_orders.c.id, models.Todo.owner_id == owner_id)
+            .values(order=new_orders.c.pos)
+        )
+    await db.execute(stmt.execution_options(synchronize_session=False))
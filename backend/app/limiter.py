@@ -1,3 +1,5 @@
+import os
+
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
@@ -6,4 +8,27 @@ from slowapi.util import get_remote_address
 #
 # - key_func: 制限の単位を何にするか。get_remote_address は「IPアドレスごと」にカウントすることを意味します。
 # - default_limits: 個別に制限が設定されていないAPIに対するデフォルトの制限（ここでは1分間に100回まで）。
-limiter = Limiter(key_func=get_remote_address, default_limits=["100/minute"])
+# - storage_uri: カウンターの保存先。プロセス内（memory://）だとワーカーごとに別々に数えられ、
+#   4ワーカーなら実質「制限×4回」まで通ってしまうため、REDIS_URL が設定されていれば Redis で全ワーカー共通に数えます。
+# - strategy: "moving-window" は直近1分間のリクエスト時刻を Redis のソート済みセットで管理する方式で、
+#   固定ウィンドウ（毎分0秒でリセット）のように境界の前後で2倍のリクエストが通ってしまうことがありません。
+# - in_memory_fallback_enabled: Redis に接続できない間はプロセス内のカウンターで制限を続けます。
+# - storage_options: Redis への接続・応答のタイムアウト（秒）。cache.py と同じく短めにします。
+#   注意: SlowAPIMiddleware はカウンターの確認を同期処理（同期版の redis クライアント）で行うため、
+#   Redis を使う場合は全リクエストで、イベントループ上で Redis との往復を待つことになります。
+#   タイムアウトがないと、Redis が接続を拒否せずに応答しなくなった場合にワーカー全体が止まってしまい、
+#   例外も発生しないためプロセス内のカウンターへの切り替え（in_memory_fallback_enabled）も行われません。
+#   タイムアウトさせることで例外となり、プロセス内のカウンターに切り替わります。
+limiter = Limiter(
+    key_func=get_remote_address,
+    default_limits=["100/minute"],
+    storage_uri=os.getenv("REDIS_URL") or "memory://",
+    storage_options={"socket_timeout": 0.5, "socket_connect_timeout": 0.5},
+    strategy="moving-window",
+    in_memory_fallback_enabled=True,
+)
+
+# 認証系エンドポイント（/auth/login, /auth/register）用の、より厳しい制限。
+# これらはbcryptによるハッシュ計算（CPU負荷が高い処理）を伴うため、大量に送られるとサーバーのCPUを使い切ってしまいます。
+# パスワード総当たり攻撃への対策も兼ねて、IPアドレスごとに「1分間に5回まで」を既定値とします（環境変数で変更可能）。
+AUTH_RATE_LIMIT = os.getenv("AUTH_RATE_LIMIT", "5/minute")
@@ -1,19 +1,18 @@
 # 必要なライブラリとモジュールのインポート
+import copy
 import logging
+import logging.handlers
+import os
+import queue
 import sys
 from contextlib import asynccontextmanager  # ライフサイクル管理のための Context Manager をインポート
 from fastapi import FastAPI, Request                 # FastAPI のメインクラスをインポート
 from fastapi.middleware.cors import CORSMiddleware # CORSミドルウェアをインポート
 from pythonjsonlogger import jsonlogger # JSONロガー
-from slowapi import Limiter, _rate_limit_exceeded_handler # Rate Limiting
-from slowapi.util import get_remote_address # Rate Limiting
+from slowapi import _rate_limit_exceeded_handler # Rate Limiting
 from slowapi.errors import RateLimitExceeded # Rate Limiting
 from slowapi.middleware import SlowAPIMiddleware # Rate Limiting
 
-# アプリケーション固有のモジュールをインポート
-from .routers import todos, auth, ai                # ToDo関連のエンドポイント（ルーター）をインポート
-from .database import engine, Base          # データベース接続エンジンと、モデルのベースクラスをインポート
-
 # ----------------------------------------------------------------------
 # 0. ロギングとセキュリティ設定
 # ----------------------------------------------------------------------
@@ -28,6 +27,12 @@ from .database import engine, Base          # データベース接続エンジ
 #  - DatadogやAWS CloudWatchなどのログ監視ツールで、自動的に解析（パース）可能になります
 #  - 例えば「レベルがERRORのログだけ抽出したい」などが簡単になります
 #  - 「運用時の可観測性（Observability）」を高めるための重要な設定です
+#
+# 【キュー経由の出力】
+# アプリケーションの起動中（lifespan の間）は、JSONへの変換と標準出力への書き込みを
+# リクエストを処理するイベントループ上では行わず、専用のスレッドで行います。
+# （コンテナのログ出力が詰まると write() が待たされ、その間すべてのリクエストが止まってしまうため）
+# ログを出す側は QueueHandler でキューに積むだけで、QueueListener のスレッドが取り出して出力します。
 logger = logging.getLogger(__name__)
 logHandler = logging.StreamHandler(sys.stdout)
 formatter = jsonlogger.JsonFormatter(
@@ -37,6 +42,57 @@ formatter = jsonlogger.JsonFormatter(
 logHandler.setFormatter(formatter)
 root_logger = logging.getLogger()
 root_logger.addHandler(logHandler)
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    ログレコードを加工せずにキューへ積む QueueHandler
+
+    標準の QueueHandler は、キューに積む前にメッセージを整形し、例外情報（exc_info）を
+    メッセージの文字列に埋め込んで消してしまいます（別プロセスへ送るための処理）。
+    そのままでは JSON ログの exc_info フィールドが出力されなくなるため、
+    同じプロセス内のキューだけを使うこのアプリでは、例外情報を残したまま整形は logHandler に任せます。
+    ただし、メッセージ（msg % args）だけはログを出した時点で確定させます。
+    （専用スレッドで出力するときには、args に渡したオブジェクトの内容が変わっている可能性があるため）
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+queue_handler = _RecordQueueHandler(log_queue)
+log_listener = logging.handlers.QueueListener(log_queue, logHandler, respect_handler_level=True)
+
+
+# uvicorn の既定のログ設定では、uvicorn / uvicorn.access のロガーがそれぞれ標準出力・標準エラー出力への
+# ハンドラーを持ち、ルートロガーに伝播しません（propagate=False）。
+# そのままではリクエストごとのアクセスログがイベントループ上で同期的に書き込まれるため、
+# これらのハンドラーを外してルートロガー（キュー経由のJSONログ）に流します。
+UVICORN_LOGGER_NAMES = ("uvicorn", "uvicorn.access")
+
+
+def start_queued_logging() -> None:
+    """ログの出力先を、標準出力への直接書き込みからキュー（専用スレッドで出力）に切り替える"""
+    for name in UVICORN_LOGGER_NAMES:
+        uvicorn_logger = logging.getLogger(name)
+        for handler in list(uvicorn_logger.handlers):
+            uvicorn_logger.removeHandler(handler)
+        uvicorn_logger.propagate = True
+    root_logger.removeHandler(logHandler)
+    root_logger.addHandler(queue_handler)
+    log_listener.start()
+
+
+def stop_queued_logging() -> None:
+    """キューに残っているログをすべて出力してから専用スレッドを止め、標準出力への直接書き込みに戻す"""
+    root_logger.removeHandler(queue_handler)
+    log_listener.stop()
+    root_logger.addHandler(logHandler)
+
 root_logger.setLevel(logging.INFO)
 
 # 【Rate Limiter（レート制限）のインポート】
@@ -44,6 +100,12 @@ root_logger.setLevel(logging.INFO)
 # DoS攻撃（サービス停止攻撃）や、パスワード総当たり攻撃（ブルートフォース）への対策として必須です。
 # 具体的な制限ルール（例: 1分に5回まで）は、各エンドポイント（routers/auth.pyなど）で指定します。
 from .limiter import limiter # Rate Limiter Instance
+from .cache import close_cache # Redis キャッシュ
+
+# アプリケーション固有のモジュールをインポート
+# （読み込み時にログを出すモジュール（database.py）があるため、ロギングの設定より後で読み込む）
+from .routers import todos, auth, ai                # ToDo関連のエンドポイント（ルーター）をインポート
+from .migrate import create_tables         # テーブル作成処理（RUN_MIGRATIONS=1 のときだけ使用）
 
 # ----------------------------------------------------------------------
 # 1. アプリケーションのライフサイクル管理 (起動/終了時の処理)
@@ -55,16 +117,25 @@ async def lifespan(app: FastAPI):
     FastAPI の起動時と終了時に実行される処理を定義します。
     yield までの処理が起動時 (startup)、yield 以降の処理が終了時 (shutdown) に実行されます。
     """
-    logger.info("アプリケーション起動: データベース初期化を開始します。")
-    try:
-        # データベースエンジンを使用して非同期セッションを開始
-        async with engine.begin() as conn:
-            # データベースのスキーマ (テーブル) を作成 (存在しない場合のみ作成されます)
-            await conn.run_sync(Base.metadata.create_all)
-        logger.info("データベース初期化が完了しました。")
-    except Exception as e:
-        logger.error(f"データベース初期化中にエラーが発生しました: {e}", exc_info=True)
-        # 実際にはここで適切なエラーハンドリングを行うべきです
+    # 以降のログは専用スレッド経由で出力する
+    start_queued_logging()
+
+    # テーブル作成（create_all）は環境変数 RUN_MIGRATIONS=1 のときだけ実行します。
+    # 複数のワーカー・コンテナで起動する本番環境では、起動のたびに全プロセスがスキーマを問い合わせる（DDLが競合する）のを避けるため、
+    # デプロイ時にマイグレーション専用のジョブ（python -m app.migrate）を1度だけ実行してください。
+    if os.getenv("RUN_MIGRATIONS") == "1":
+        logger.info("アプリケーション起動: データベース初期化を開始します。")
+        try:
+            await create_tables()
+            logger.info("データベース初期化が完了しました。")
+        except Exception as e:
+            logger.error(f"データベース初期化中にエラーが発生しました: {e}", exc_info=True)
+            # 実際にはここで適切なエラーハンドリングを行うべきです
+    else:
+        logger.info("アプリケーション起動: RUN_MIGRATIONS が指定されていないため、データベース初期化をスキップします。")
+
+    # OpenAI クライアントはプロセスで1つだけ作成し、接続プールを全リクエストで使い回す
+    app.state.openai = ai.create_openai_client()
 
     # ここでアプリケーション本体が起動し、リクエストの処理が可能になります
     yield
@@ -73,6 +144,13 @@ async def lifespan(app: FastAPI):
     # アプリケーション終了時の処理 (shutdown)
     # ------------------------------------
     logger.info("アプリケーション終了処理を実行します。")
+    # Redis の接続プールを閉じる（REDIS_URL 未設定時は何もしない）
+    await close_cache()
+    # OpenAI クライアントの接続プールを閉じる
+    if app.state.openai is not None:
+        await app.state.openai.close()
+    # キューに残っているログをすべて出力してから、ログ出力用のスレッドを停止する
+    stop_queued_logging()
     # ここにクリーンアップ処理 (例: データベース接続プールを閉じるなど) を記述できます
     # await engine.dispose()  # 必要に応じて
 
@@ -104,8 +182,9 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,       # 許可するオリジン
     allow_credentials=True,      # クッキーなどの資格情報を許可
-    allow_methods=["*"],         # 全てのHTTPメソッド (GET, POST, etc.) を許可
+    allow_methods=["GET", "POST", "PATCH", "PUT", "DELETE", "OPTIONS"],  # APIで使用するHTTPメソッドを明示的に許可（"*" の展開を省く）
     allow_headers=["*"],         # 全てのHTTPヘッダーを許可
+    expose_headers=["X-Error-Code"],  # フロントエンドからエラーコードのヘッダーを読めるようにする
 )
 
 # ----------------------------------------------------------------------
@@ -115,4 +194,23 @@ app.add_middleware(
 # 外部ファイル (routers/todos.py) で定義されたエンドポイントを組み込む
 app.include_router(auth.router)
 app.include_router(todos.router)
-app.include_router(ai.router)
\ No newline at end of file
+app.include_router(ai.router)
+
+# ----------------------------------------------------------------------
+# 5. 本番用の起動エントリポイント (python -m app.main)
+# ----------------------------------------------------------------------
+
+# uvicorn[standard] に含まれる uvloop（高速なイベントループ）と httptools（C実装のHTTPパーサー）を明示的に使用し、
+# CPUコア数（または環境変数 UVICORN_WORKERS）分のワーカープロセスでリクエストを並列に処理します。
+# 開発時のホットリロードは docker-compose.yml の uvicorn --reload コマンドを使用してください。
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "app.main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("UVICORN_WORKERS", str(os.cpu_count() or 4))),
+    )
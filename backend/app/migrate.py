@@ -0,0 +1,70 @@
+import asyncio
+import logging
+
+from sqlalchemy import text
+
+from .database import Base, engine
+from . import models  # noqa: F401  モデルを読み込んで Base.metadata にテーブルを登録する
+
+# ----------------------------------------------------------------------
+# テーブル作成（マイグレーション）処理
+# ----------------------------------------------------------------------
+# アプリケーション本体（リクエストを処理するプロセス）とは別に、デプロイ時に1度だけ実行します。
+#
+#   python -m app.migrate
+#
+# docker-compose では migrate サービスとして実行され、完了してから backend が起動します。
+# 起動するワーカーがそれぞれスキーマを問い合わせる（DDLが競合する）のを避けるため、
+# 通常の起動時（lifespan）では環境変数 RUN_MIGRATIONS=1 のときだけ実行されます。
+
+logger = logging.getLogger(__name__)
+
+# 同時に複数のプロセスから実行された場合に、1つずつ順番に実行させるためのロックID（任意の固定値）
+MIGRATION_LOCK_ID = 251025
+
+# 既存のテーブルを現在のモデルに合わせるための DDL（PostgreSQL のみ）
+# create_all は存在しないテーブルを作成するだけで、既存のテーブルのインデックスや既定値は変更しないため、
+# 以前のバージョンで作成されたDBでもここで追いつかせます。何度実行しても同じ結果になる（冪等な）文だけを並べること。
+UPGRADE_STATEMENTS = (
+    # 日時カラムの既定値を DB 側（now()）に設定する
+    "ALTER TABLE users ALTER COLUMN created_at SET DEFAULT now()",
+    "ALTER TABLE todos ALTER COLUMN created_at SET DEFAULT now()",
+    "ALTER TABLE todos ALTER COLUMN updated_at SET DEFAULT now()",
+    # owner_id を先頭にした複合インデックス（一覧取得・更新・削除用）
+    'CREATE INDEX IF NOT EXISTS ix_todos_owner_order ON todos (owner_id, "order")',
+    "CREATE INDEX IF NOT EXISTS ix_todos_owner_id_id ON todos (owner_id, id)",
+    # 複合インデックスや主キーのインデックスと重複するため不要になったインデックス
+    "DROP INDEX IF EXISTS ix_todos_owner_id",
+    "DROP INDEX IF EXISTS ix_todos_id",
+    "DROP INDEX IF EXISTS ix_users_id",
+)
+
+
+async def create_tables() -> None:
+    """
+    データベースのスキーマ（テーブル）を作成する（存在しない場合のみ作成されます）
+
+    PostgreSQL では、既存のテーブルのインデックスや既定値も UPGRADE_STATEMENTS で現在のモデルに合わせます。
+    """
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # トランザクション終了時に自動で解放されるアドバイザリーロックで、DDLの同時実行を防ぐ
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+        await conn.run_sync(Base.metadata.create_all)
+        if conn.dialect.name == "postgresql":
+            for statement in UPGRADE_STATEMENTS:
+                await conn.execute(text(statement))
+
+
+async def main() -> None:
+    logger.info("データベース初期化を開始します。")
+    try:
+        await create_tables()
+    finally:
+        await engine.dispose()
+    logger.info("データベース初期化が完了しました。")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
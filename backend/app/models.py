@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, Index
 from sqlalchemy.orm import relationship
-from datetime import datetime, timezone
+from sqlalchemy.sql import func
 from .database import Base  # Baseクラスが定義されている場所に応じてインポート
 # from your_project_name.database import Base # 例: プロジェクト名を使った絶対インポート推奨
 
@@ -12,8 +12,13 @@ class User(Base):
     """
     __tablename__ = "users"
 
+    # eager_defaults: INSERT 時に DB 側で設定された既定値（created_at など）を RETURNING で同時に取得する
+    # （指定しないと flush 後にこれらの属性を参照したとき、非同期セッションでは暗黙のSELECTができずエラーになる）
+    __mapper_args__ = {"eager_defaults": True}
+
     # 主キー: ユーザーを一意に識別するID（自動採番）
-    id = Column(Integer, primary_key=True, index=True)
+    # 主キーには自動でインデックスが作られるため、index=True は指定しない（同じ内容のインデックスが二重にできてしまう）
+    id = Column(Integer, primary_key=True)
     
     # メールアドレス: 一意制約付き（同じメールアドレスは登録不可）、インデックスあり、必須
     email = Column(String(255), unique=True, index=True, nullable=False)
@@ -22,8 +27,11 @@ class User(Base):
     # 注意: 平文のパスワードは保存しない
     hashed_password = Column(String(255), nullable=False)
     
-    # アカウント作成日時: ユーザーが登録された日時を自動記録
-    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), nullable=False)
+    # アカウント作成日時: ユーザーが登録された日時をDB側（now()）で自動記録
+    # - default=func.now(): INSERT 文の中に now() を埋め込む（Python側で日時を作らない）。
+    #   カラムに DEFAULT が設定されていない、以前のバージョンで作成されたテーブルでも NULL にならない
+    # - server_default=func.now(): 新しく作成するテーブルのカラムにも DEFAULT now() を設定する
+    created_at = Column(DateTime(timezone=True), default=func.now(), server_default=func.now(), nullable=False)
     
     # リレーションシップ: このユーザーが所有するTodoアイテムへの参照
     # back_populates: Todoモデルの"owner"属性と双方向にリンク
@@ -34,11 +42,23 @@ class Todo(Base):
     # テーブル名: 一般的に複数形を使用します
     __tablename__ = "todos"
 
+    # User と同様に、INSERT 時に DB 側の既定値（created_at / updated_at）を RETURNING で取得する
+    __mapper_args__ = {"eager_defaults": True}
+
+    # 複合インデックス: Todoへのクエリは必ず owner_id で絞り込むため、owner_id を先頭にしたインデックスを用意します
+    # - ix_todos_owner_order: 一覧取得（WHERE owner_id = ? ORDER BY order）をソートなしのインデックス走査にする
+    # - ix_todos_owner_id_id: 更新・削除・並び替え（WHERE owner_id = ? AND id = ?）の検索用
+    # owner_id 単独のインデックスは、owner_id を先頭にしたこれらの複合インデックスで代用できるため作成しない
+    # 以前のバージョンで作成された既存DBのインデックスの追加・削除は、app/migrate.py（UPGRADE_STATEMENTS）で行う
+    __table_args__ = (
+        Index("ix_todos_owner_order", "owner_id", "order"),
+        Index("ix_todos_owner_id_id", "owner_id", "id"),
+    )
+
     # 主キー (Primary Key): レコードを一意に識別するためのID
     id = Column(
         Integer, 
-        primary_key=True, # 主キーとして設定
-        index=True        # 検索速度向上のためにインデックスを作成
+        primary_key=True, # 主キーとして設定（主キーのインデックスは自動で作成されるため index=True は不要）
     )
     
     # タイトル: 必須項目 (nullable=False)、長さは100文字に制限
@@ -62,28 +82,35 @@ class Todo(Base):
     # 表示順序: 並び替え用 (小さい数値が上)
     order = Column(Integer, default=0, nullable=False)
     
-    # 作成日時: レコード作成時に現在の日時を自動設定
+    # 作成日時: レコード作成時に現在の日時をDB側（now()）で自動設定（User.created_at と同じく default / server_default の両方を指定）
     created_at = Column(
         DateTime(timezone=True), 
-        default=lambda: datetime.now(timezone.utc), 
+        default=func.now(),
+        server_default=func.now(), 
         nullable=False
     )
     
-    # 更新日時: レコード更新時に現在の日時を自動設定
+    # 更新日時: レコード更新時に現在の日時をDB側（now()）で自動設定
     updated_at = Column(
         DateTime(timezone=True), 
-        default=lambda: datetime.now(timezone.utc), 
-        onupdate=lambda: datetime.now(timezone.utc), # レコードが更新されるたびにこの値も更新されます
+        default=func.now(),
+        server_default=func.now(), 
+        # レコードが更新されるたびに UPDATE 文の中で now() が設定されます
+        # （並び替えで複数行を1文で更新する場合も、Python側で行ごとに日時を作る必要がありません）
+        onupdate=func.now(),
         nullable=False
     )
 
     # 外部キー: このTodoを所有するユーザーのID（usersテーブルのidを参照）
     # nullable=True: 現在は任意だが、認証機能を追加する場合は必須（nullable=False）に変更することを推奨
-    owner_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     
     # リレーションシップ: このTodoを所有するユーザーへの参照
     # back_populates: Userモデルの"todos"属性と双方向にリンク
-    owner = relationship("User", back_populates="todos")
+    # lazy="raise": アクセス時に暗黙のSELECTを発行せず、エラーにする
+    #   （非同期セッションでは遅延読み込みができないうえ、一覧の各Todoで owner を参照すると
+    #    Todoの件数だけSELECTが発行される「N+1問題」になるため。必要な場合は selectinload で明示的に読み込むこと）
+    owner = relationship("User", back_populates="todos", lazy="raise")
 
     # デバッグやログ出力で役立つ表現メソッド
     def __repr__(self):
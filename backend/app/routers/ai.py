@@ -1,10 +1,15 @@
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Request, status
 from pydantic import BaseModel
 import openai
 import os
-import json
+import hashlib
 import logging
-from typing import List
+import re
+from typing import List, Optional
+
+import orjson
+
+from ..cache import cache_get, cache_set
 
 # ----------------------------------------------------------------------
 # AI (LLM) 連携用のルーター
@@ -19,16 +24,49 @@ class AIRequest(BaseModel):
 class AIResponse(BaseModel):
     subtasks: List[str]
 
+# 同じタスク名に対する分解結果は Redis にキャッシュし、OpenAI API の呼び出し（数秒・有料）を省略します。
+# - 通常のキャッシュは1日で期限切れにする
+# - OpenAI の呼び出しに失敗したときのために、同じ結果を期限の長い「予備」としても保存しておき、
+#   502 エラーを返す前にそちらを返す（古くても何も返さないよりは良いため）
+AI_CACHE_TTL_SECONDS = 86400
+AI_STALE_CACHE_TTL_SECONDS = 7 * 86400
+
+# AIの応答を囲む Markdown のコードブロック（```json ... ``` / ``` ... ```）を取り除くための正規表現
+# （モジュール読み込み時に1度だけコンパイルしておく）
+# 取り除くのは行頭・行末にあるフェンス（```json / ```）だけで、行の途中（JSONの文字列の中など）にある ``` は残す
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.MULTILINE)
+
+
+def _breakdown_cache_key(title: str) -> str:
+    """タスク名からキャッシュのキーを作る（前後の空白・大文字小文字の違いは同じタスクとみなす）"""
+    digest = hashlib.sha256(title.strip().lower().encode("utf-8")).hexdigest()
+    return f"ai:breakdown:{digest}"
+
+
+def create_openai_client() -> Optional[openai.AsyncOpenAI]:
+    """
+    アプリ全体で共有する OpenAI クライアントを作成する（main.py の lifespan で1度だけ呼ばれる）
+
+    クライアントは内部に HTTP の接続プールを持つため、リクエストごとに作り直すと
+    毎回 TCP / TLS の接続からやり直しになります。起動時に1つだけ作って使い回します。
+    APIキーが設定されていない場合、またはテスト用のダミー値の場合は None（モックモード）を返します。
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key or api_key == "dummy":
+        return None
+    return openai.AsyncOpenAI(api_key=api_key, max_retries=2, timeout=20)
+
 @router.post("/breakdown", response_model=AIResponse)
-async def breakdown_task(req: AIRequest):
+async def breakdown_task(request: Request, req: AIRequest):
     """
     タスク分解API:
     ユーザーが入力した「大きなタスク」を、AIが「3〜5個の具体的なサブタスク」に分解して返します。
     """
-    api_key = os.getenv("OPENAI_API_KEY")
+    # lifespan で作成した共有クライアント（lifespan を通さないテストなどでは存在しない）
+    client: Optional[openai.AsyncOpenAI] = getattr(request.app.state, "openai", None)
     
-    # APIキーが設定されていない場合、またはテスト用のダミー値の場合はモックデータを返す
-    if not api_key or api_key == "dummy":
+    # クライアントがない（APIキーが設定されていない）場合はモックデータを返す
+    if client is None:
         logger.warning("OPENAI_API_KEYが設定されていないため、モックデータを返します。")
         # 0.5秒程度の擬似的な遅延を入れると本物っぽくなりますが、ここでは省略
         return AIResponse(subtasks=[
@@ -37,8 +75,11 @@ async def breakdown_task(req: AIRequest):
             f"【AI提案】{req.title} に必要なものを準備する",
         ])
 
-    client = openai.AsyncOpenAI(api_key=api_key)
-    
+    cache_key = _breakdown_cache_key(req.title)
+    cached = await cache_get(cache_key)
+    if cached is not None:
+        return AIResponse.model_validate_json(cached)
+
     # プロンプトエンジニアリング
     # 具体的なJSON配列のみを返すように強く指示
     prompt = f"""
@@ -58,25 +99,31 @@ async def breakdown_task(req: AIRequest):
         )
         content = response.choices[0].message.content
         
-        # JSONパース (Markdownのコードブロック ```json ... ``` が含まれる場合の除去処理)
-        if "```json" in content:
-            content = content.replace("```json", "").replace("```", "")
-        elif "```" in content:
-            content = content.replace("```", "")
-            
-        subtasks = json.loads(content.strip())
+        # JSONパース (Markdownのコードブロック ```json ... ``` が含まれる場合は除去してから読み込む)
+        # orjson は C で実装されており、標準の json モジュールより高速
+        subtasks = orjson.loads(_FENCE_RE.sub("", content).strip())
         
         # 配列であることを確認
         if not isinstance(subtasks, list):
             raise ValueError("AIが配列形式を返しませんでした")
             
-        return AIResponse(subtasks=subtasks)
+        result = AIResponse(subtasks=subtasks)
 
     except Exception as e:
         logger.error(f"AI生成中にエラーが発生しました: {e}", exc_info=True)
+        # 以前の結果が残っていれば、エラーにせずそれを返す
+        stale = await cache_get(f"{cache_key}:stale")
+        if stale is not None:
+            logger.warning("AIサービスの呼び出しに失敗したため、キャッシュ済みの結果を返します。")
+            return AIResponse.model_validate_json(stale)
         # 失敗時は500エラーではなく、空のリストなどを返す実装も考えられますが、
         # ここではユーザーに通知するためにエラーを上げます
         raise HTTPException(
             status_code=status.HTTP_502_BAD_GATEWAY,
             detail="AIサービスの呼び出しに失敗しました。"
         )
+
+    cached_json = result.model_dump_json()
+    await cache_set(cache_key, cached_json, AI_CACHE_TTL_SECONDS)
+    await cache_set(f"{cache_key}:stale", cached_json, AI_STALE_CACHE_TTL_SECONDS)
+    return result
@@ -6,7 +6,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from .. import crud, schemas
 from ..auth import create_access_token
 from ..database import get_db
-from ..limiter import limiter
+from ..limiter import AUTH_RATE_LIMIT, limiter
 
 # ----------------------------------------------------------------------
 # 認証関連のAPIエンドポイントを定義するルーター
@@ -21,8 +21,8 @@ router = APIRouter(prefix="/auth", tags=["Auth"])
 
 
 @router.post("/register", response_model=schemas.UserOut, status_code=status.HTTP_201_CREATED)
-@limiter.limit("5/minute")
-async def register(request: Request, user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+@limiter.limit(AUTH_RATE_LIMIT)
+async def register(request: Request, user: schemas.UserCreate, db: AsyncSession = Depends(get_db, scope="function")):
     """
     新規ユーザー登録エンドポイント
     
@@ -42,31 +42,20 @@ async def register(request: Request, user: schemas.UserCreate, db: AsyncSession
     Raises:
         HTTPException: メールアドレスが既に登録されている場合（400 Bad Request）
     """
-    # 1. 重複チェック
-    # 受け取ったメールアドレスが、既にデータベースに存在するかを確認します。
-    # await を使用して、非同期にデータベース検索を行います（I/O待ち時間の効率化）。
-    existing = await crud.get_user_by_email(db, email=user.email)
-    
-    # 既に存在する場合は、重複エラーとして 400 Bad Request を返します。
-    if existing:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="このメールアドレスは既に登録されています",
-        )
-    
-    # 2. ユーザー作成
-    # バリデーションと重複チェックをパスした場合のみ、ユーザーを作成します。
-    # CRUD操作を行う関数内で、パスワードのハッシュ化などの処理が行われます。
+    # 1. ユーザー作成
+    # 重複チェックと登録は、CRUD関数内の1回の INSERT ... ON CONFLICT でまとめて行います。
+    # （事前に SELECT で確認すると、DBとの往復が増えるうえ、同時登録時に競合が起きるため）
+    # パスワードのハッシュ化などの処理もCRUD関数内で行われます。
     created = await crud.create_user(db, user=user)
     
-    # 3. レスポンス
+    # 2. レスポンス
     # 作成されたユーザー情報を返します（パスワードフィールドは除外されています）。
     return created
 
 
 @router.post("/login", response_model=schemas.Token)
-@limiter.limit("5/minute")
-async def login(request: Request, user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+@limiter.limit(AUTH_RATE_LIMIT)
+async def login(request: Request, user: schemas.UserCreate, db: AsyncSession = Depends(get_db, scope="function")):
     """
     ユーザーログインエンドポイント
     
@@ -102,8 +91,13 @@ async def login(request: Request, user: schemas.UserCreate, db: AsyncSession = D
     # 認証に成功したら、一時的なアクセス許可証であるトークンを作成します。
     # sub (Subject): トークンが誰のものかを示す識別子。ここでは一意なメールアドレスを使用しています。
     # expires_delta: トークンの有効期限。セキュリティのため、必要最小限（例: 60分）に設定します。
+    # uid / created_at: 以降のリクエストで、DBを検索せずにトークンだけからユーザー情報を組み立てるための情報
     access_token = create_access_token(
-        data={"sub": db_user.email},  # トークンに含めるユーザー識別情報
+        data={  # トークンに含めるユーザー識別情報
+            "sub": db_user.email,
+            "uid": db_user.id,
+            "created_at": db_user.created_at.isoformat(),
+        },
         expires_delta=timedelta(minutes=60),  # トークンの有効期限（60分）
     )
     
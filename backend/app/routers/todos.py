@@ -1,5 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, status # statusをインポート
+import hashlib
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status # statusをインポート
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
+from ..cache import cache_delete_after_commit, cache_get, cache_set
 from ..database import get_db
 from .. import crud, schemas
 from ..auth import get_current_user
@@ -9,23 +13,74 @@ from ..auth import get_current_user
 # tags=["Todos"]でAPIドキュメント（Swagger UI/Redoc）でのグループ名を指定
 router = APIRouter(prefix="/todos", tags=["Todos"])
 
+# ToDo一覧のレスポンス（JSON）はユーザーごとに Redis へ短時間キャッシュする（REDIS_URL 設定時のみ）
+# 一覧が変わるのは同じユーザーが作成・更新・削除・並び替えをしたときだけなので、
+# それらのエンドポイントでキャッシュを削除（無効化）する
+# 削除はコミットの後に行う（cache_delete_after_commit）。コミット前に削除すると、その間の一覧取得が古い一覧を書き戻してしまうため
+TODOS_CACHE_TTL_SECONDS = 30
+
+
+def _todos_cache_key(user_id: int) -> str:
+    return f"todos:{user_id}"
+
+
+# 一覧には ETag（レスポンス内容のハッシュ値）を付け、クライアントが If-None-Match で送ってきた ETag と
+# 一致すれば（一覧が変わっていなければ）本文なしの 304 Not Modified を返して転送量を減らす
+# キャッシュには「ETag + 空白 + JSON」を1つの値として保存し、ヒット時にハッシュを計算し直さないようにする
+def _make_etag(payload: bytes) -> bytes:
+    return b'W/"' + hashlib.blake2b(payload, digest_size=12).hexdigest().encode("ascii") + b'"'
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match ヘッダーに指定されたいずれかの ETag が一致するか"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip() for candidate in if_none_match.split(",")}
+    return etag in candidates or "*" in candidates
+
+
+def _todos_response(request: Request, etag_bytes: bytes, payload: bytes) -> Response:
+    etag = etag_bytes.decode("ascii")
+    if _etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(content=payload, media_type="application/json", headers={"ETag": etag})
+
+# 一覧のシリアライズ用のアダプター（バリデーターとシリアライザーの構築はコストが高いため、起動時に1度だけ作成する）
+# 検証・JSON化はどちらも pydantic-core（Rust）で行われるため、1件ずつ model_dump するより大幅に速い
+_TODO_LIST_ADAPTER = TypeAdapter(list[schemas.TodoOut])
+
 # --- ToDoアイテムの読み取り（全件取得） ---
 @router.get(
     "/",
     response_model=list[schemas.TodoOut], # レスポンスのPydanticモデルを指定（リスト型であることに注意）
     status_code=status.HTTP_200_OK # 成功時のHTTPステータスコードを明示的に指定（200 OK）
 )
-# Depends(get_db)により、リクエストごとに非同期DBセッションを取得
+# Depends(get_db, scope="function")により、リクエストごとに非同期DBセッションを取得
 async def read_todos(
-    db: AsyncSession = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_db, scope="function"),
     current_user: schemas.UserOut = Depends(get_current_user),
 ) -> list[schemas.TodoOut]:
     """
     全てのToDoアイテムを取得します。
+    一覧が前回の取得から変わっていない場合（If-None-Match が ETag と一致する場合）は 304 Not Modified を返します。
     """
+    # キャッシュがあれば、DBへの問い合わせもシリアライズもせず、保存済みのJSONをそのまま返す
+    cache_key = _todos_cache_key(current_user.id)
+    cached = await cache_get(cache_key)
+    if cached is not None and cached.startswith(b'W/"'):
+        etag, _, payload = cached.partition(b" ")
+        return _todos_response(request, etag, payload)
+
     # crudモジュールの非同期関数を呼び出し、データベースからToDoリストを取得
     todos = await crud.get_todos(db, owner_id=current_user.id)
-    return todos # 取得したToDoリストを返す
+    payload = _TODO_LIST_ADAPTER.dump_json(
+        _TODO_LIST_ADAPTER.validate_python(todos, from_attributes=True)
+    )
+    etag = _make_etag(payload)
+    await cache_set(cache_key, etag + b" " + payload, TODOS_CACHE_TTL_SECONDS)
+    return _todos_response(request, etag, payload) # 取得したToDoリストを返す
 
 # --- ToDoアイテムの作成 ---
 @router.post(
@@ -36,7 +91,7 @@ async def read_todos(
 # リクエストボディをschemas.TodoCreateモデルで検証
 async def create_todo(
     todo: schemas.TodoCreate,
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_db, scope="function"),
     current_user: schemas.UserOut = Depends(get_current_user),
 ) -> schemas.TodoOut:
     """
@@ -44,6 +99,7 @@ async def create_todo(
     """
     # crudモジュールの非同期関数を呼び出し、ToDoアイテムを作成
     new_todo = await crud.create_todo(db, todo=todo, owner_id=current_user.id)
+    cache_delete_after_commit(db, _todos_cache_key(current_user.id))
     return new_todo # 作成されたToDoアイテムを返す
 
 # --- ToDoアイテムの更新（部分更新/全体更新） ---
@@ -56,7 +112,7 @@ async def create_todo(
 async def update_todo(
     todo_id: int,
     todo: schemas.TodoUpdate, # リクエストボディをschemas.TodoUpdateモデルで検証
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_db, scope="function"),
     current_user: schemas.UserOut = Depends(get_current_user),
 ) -> schemas.TodoOut:
     """
@@ -72,20 +128,21 @@ async def update_todo(
             status_code=status.HTTP_404_NOT_FOUND, # 404 Not Found
             detail=f"Todo with id {todo_id} not found" # 詳細なエラーメッセージ
         )
+    cache_delete_after_commit(db, _todos_cache_key(current_user.id))
     return updated # 更新されたToDoアイテムを返す
 
 # --- ToDoアイテムの削除 ---
 @router.delete(
     "/{todo_id}",
+    response_model=schemas.TodoDeleted, # 削除成功時のメッセージと削除したID
     status_code=status.HTTP_200_OK, # 成功時のHTTPステータスコードを明示的に指定（200 OK）
-    # 削除成功時はレスポンスボディとしてJSONオブジェクトを返すためresponse_modelは不要
 )
 # todo_id（パスパラメータ）を受け取る
 async def delete_todo(
     todo_id: int,
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_db, scope="function"),
     current_user: schemas.UserOut = Depends(get_current_user),
-) -> dict: # 辞書型（JSONオブジェクト）を返すことを示唆
+) -> schemas.TodoDeleted:
     """
     指定されたIDのToDoアイテムを削除します。
     """
@@ -99,18 +156,20 @@ async def delete_todo(
             status_code=status.HTTP_404_NOT_FOUND, # 404 Not Found
             detail=f"Todo with id {todo_id} not found" # 詳細なエラーメッセージ
         )
+    cache_delete_after_commit(db, _todos_cache_key(current_user.id))
     # 削除成功メッセージを返す
-    return {"message": "Deleted successfully", "todo_id": todo_id}
+    return schemas.TodoDeleted(message="Deleted successfully", todo_id=todo_id)
 
 # --- ToDo並び替え ---
-@router.post("/reorder", status_code=status.HTTP_200_OK)
+@router.post("/reorder", response_model=schemas.Message, status_code=status.HTTP_200_OK)
 async def reorder_todos(
     payload: schemas.TodoReorder,
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_db, scope="function"),
     current_user: schemas.UserOut = Depends(get_current_user),
-):
+) -> schemas.Message:
     """
     ToDoの並び順を更新します。
     """
     await crud.reorder_todos(db, todo_ids=payload.todo_ids, owner_id=current_user.id)
-    return {"message": "Order updated"}
\ No newline at end of file
+    cache_delete_after_commit(db, _todos_cache_key(current_user.id))
+    return schemas.Message(message="Order updated")
\ No newline at end of file
@@ -27,9 +27,6 @@ class Token(BaseModel):
     access_token: str
     token_type: str = "bearer"
 
-class TokenData(BaseModel):
-    email: Optional[str] = None
-
 # ----------------------------------------------------------------------
 # 1. 基本となるTo Doアイテムのスキーマ (TodoBase)
 # ----------------------------------------------------------------------
@@ -120,4 +117,19 @@ class TodoOut(TodoBase):
     #     orm_mode = True
 
 class TodoReorder(BaseModel):
-    todo_ids: list[int]
\ No newline at end of file
+    todo_ids: list[int]
+
+# ----------------------------------------------------------------------
+# 5. 削除・並び替えのレスポンス
+# ----------------------------------------------------------------------
+# レスポンスモデルを指定すると、FastAPI は Pydantic（pydantic-core）で直接JSONのバイト列を作るため、
+# dict を返して標準の json モジュールでシリアライズするより速くなります。
+
+class TodoDeleted(BaseModel):
+    """ToDo削除時のレスポンス"""
+    message: str
+    todo_id: int
+
+class Message(BaseModel):
+    """メッセージだけを返すレスポンス"""
+    message: str
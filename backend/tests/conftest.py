@@ -1,15 +1,25 @@
+import os
+
+# アプリを読み込む前に設定する（bcrypt のコストは crud モジュールの読み込み時に決まるため）
+# テストではハッシュの強度は不要なので、bcrypt の最小値 4 にしてハッシュ化・検証の計算時間を省く
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+import orjson
 import pytest
-from httpx import AsyncClient, ASGITransport
+from httpx import AsyncClient, ASGITransport, Headers
+from sqlalchemy import event, insert
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
+from app import auth, crud, models
+from app.cache import run_pending_cache_deletes
 from app.database import Base, get_db
+from app.limiter import limiter
 from app.main import app
 
 # 【テスト用データベース設定】
 # テスト実行時には、本番のPostgreSQLではなく、メモリ上で動作するSQLiteを使用します。
-# 
+#
 # メリット:
 #  1. 高速: ディスクアクセスがないため、非常に高速にテストが終わります。
 #  2. 独立性: 実際のDBを汚さないため、テスト後にデータを消す手間が省けます。
@@ -21,53 +31,180 @@ engine = create_async_engine(
     connect_args={"check_same_thread": False}, # SQLiteをマルチスレッド（非同期）で使うための設定
     poolclass=StaticPool, # メモリ内DB接続を維持するための設定
 )
-TestingSessionLocal = sessionmaker(class_=AsyncSession, autocommit=False, autoflush=False, bind=engine)
 
-@pytest.fixture(scope="function")
-async def db_session():
+
+# SQLite のドライバ（pysqlite / aiosqlite）は独自にトランザクションを開始・終了するため、
+# そのままでは SAVEPOINT が正しく動きません。ドライバ側の制御を無効にし、BEGIN を SQLAlchemy から発行します。
+# （SQLAlchemy のドキュメントにある "Serializable isolation / Savepoints / Transactional DDL" の回避策）
+@event.listens_for(engine.sync_engine, "connect")
+def _disable_pysqlite_transaction_handling(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+
+@event.listens_for(engine.sync_engine, "begin")
+def _emit_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
+
+# 本物のパスワードハッシュ関数（_stub_password_hasher で差し替える前のもの）
+_REAL_HASH_PASSWORD = crud.hash_password
+_REAL_VERIFY_PASSWORD = crud.verify_password
+
+
+def _stub_hash_password(password: str) -> str:
+    return "stub$" + password
+
+
+def _stub_verify_password(password: str, hashed_password: str) -> bool:
+    return hashed_password == "stub$" + password
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _stub_password_hasher():
     """
-    【DBセッションFixture】
-    テスト関数 (test_*) が実行されるたびに自動で呼ばれるセットアップ関数です。
-    scope="function" なので、テスト関数1つごとに実行されます。
-    
-    1. テスト開始前にテーブルを作成 (create_all)
-    2. セッションを作成してテストに渡す (yield)
-    3. テスト終了後にテーブルを全削除 (drop_all)
-    
-    これにより、テストケース間でデータが混ざることなく、常にクリーンな状態でテストできます。
+    パスワードのハッシュ化・検証を、計算コストのない単純な文字列比較に差し替える（全テストで自動的に使われる）
+
+    ほとんどのテストは登録・ログインの流れを確認するだけで、ハッシュの強度は関係ないため、
+    bcrypt の計算を省いてテストを速くします。本物の bcrypt は real_password_hasher を使うテストで確認します。
+    """
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(crud, "hash_password", _stub_hash_password)
+        mp.setattr(crud, "verify_password", _stub_verify_password)
+        yield
+
+@pytest.fixture
+def real_password_hasher(monkeypatch):
+    """このテストの間だけ、本物の bcrypt でハッシュ化・検証する"""
+    monkeypatch.setattr(crud, "hash_password", _REAL_HASH_PASSWORD)
+    monkeypatch.setattr(crud, "verify_password", _REAL_VERIFY_PASSWORD)
+
+@pytest.fixture(scope="session")
+async def connection():
+    """
+    【DB接続Fixture】
+    テストセッション全体で1回だけ実行されるセットアップ関数です。
+    scope="session" なので、テーブル作成と接続はすべてのテストで共有されます。
+
+    1. テーブルを作成 (create_all)
+    2. 接続を開いて外側のトランザクションを開始し、テストに渡す (yield)
+    3. 全テスト終了後にトランザクションをロールバックして接続を閉じる
     """
-    # テーブル作成
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
-    
-    async with TestingSessionLocal() as session:
-        yield session
-        # 必要ならクリーンアップ
-        
-    # テーブル削除（次のテストのため）
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
+
+    async with engine.connect() as conn:
+        outer = await conn.begin()
+        yield conn
+        await outer.rollback()
+
+    await engine.dispose()
+
+# 事前に登録しておくユーザーのパスワード（seeded_users）
+SEEDED_PASSWORD = "password123"
+
+@pytest.fixture(scope="session")
+async def seeded_users(connection) -> dict[str, str]:
+    """
+    【登録済みユーザーFixture】
+    ログインや重複登録のテストで使うユーザーを、テストセッション全体で1回だけまとめて登録し、
+    {用途: メールアドレス} の辞書を返します（パスワードはすべて SEEDED_PASSWORD）。
+
+    APIを1件ずつ呼ぶ代わりに、1回の INSERT（executemany）でまとめて登録します。
+    テストごとの SAVEPOINT の外側（セッション全体のトランザクション）に登録するため、
+    各テストのロールバックでは消えません。ユーザーを変更するテストでは使わないでください。
+    """
+    users = {"login": "login@example.com", "duplicate": "duplicate@example.com"}
+    hashed_password = crud.hash_password(SEEDED_PASSWORD)
+    await connection.execute(
+        insert(models.User),
+        [{"email": email, "hashed_password": hashed_password} for email in users.values()],
+    )
+    return users
+
+@pytest.fixture(scope="session")
+def login_user(seeded_users) -> tuple[str, str]:
+    """ログインのテストで使う登録済みユーザーの (メールアドレス, パスワード)"""
+    return seeded_users["login"], SEEDED_PASSWORD
 
 @pytest.fixture(scope="function")
-async def override_get_db(db_session):
-    # FastAPIの依存性注入 (get_db) を、このテスト用セッションですり替えるための関数
+async def db_session(connection):
+    """
+    【DBセッションFixture】
+    テスト関数 (test_*) が実行されるたびに呼ばれるセットアップ関数です。
+
+    テストの開始時に SAVEPOINT を作成し、終了時にそこまでロールバックします。
+    テーブルの作成・削除をテストごとに繰り返さずに、テストケース間でデータが混ざらないようにしています。
+    セッション内の begin() / commit() も SAVEPOINT として扱われる（join_transaction_mode="create_savepoint"）ため、
+    アプリ側でコミットされたデータもロールバックで消えます。
+    """
+    savepoint = await connection.begin_nested()
+    async with AsyncSession(
+        bind=connection,
+        join_transaction_mode="create_savepoint",
+        autoflush=False,
+        # 本番 (app.database) と同じく expire_on_commit=False にして、コミット後もオブジェクトの値を参照できるようにする
+        expire_on_commit=False,
+    ) as session:
+        yield session
+    await savepoint.rollback()
+
+@pytest.fixture(autouse=True)
+async def _isolate_test(db_session):
+    """
+    テストごとに、アプリの状態をこのテスト用に切り替える（すべてのテストで自動的に使われる）
+
+    - get_db を、このテストのDBセッションを使うように上書き (Override) する
+    - プロセス内で共有されるレート制限のカウンタとキャッシュをリセットする
+    """
+    # FastAPIの依存性注入 (get_db) を、このテスト用セッションですり替える
+    # 本番の get_db と同じく、1リクエスト = 1トランザクション（ここでは SAVEPOINT）として扱う
     async def _override_get_db():
-        yield db_session
-    return _override_get_db
+        async with db_session.begin():
+            yield db_session
+        await run_pending_cache_deletes(db_session)
 
-@pytest.fixture(scope="function")
-async def client(override_get_db):
+    app.dependency_overrides[get_db] = _override_get_db
+
+    # レート制限のカウンタはプロセス内で共有されるため、テストごとにリセットします
+    # （/auth/register などの "5/minute" 制限に他のテストの呼び出しが影響しないようにする）
+    limiter.reset()
+
+    yield
+
+    # ロールバックで消えたユーザーがキャッシュに残らないようにクリア
+    crud._recent_emails.clear()
+    auth._token_cache.clear()
+
+    # テストが終わったら上書きを解除して元に戻します
+    app.dependency_overrides.clear()
+
+class OrClient(AsyncClient):
+    """
+    リクエストの JSON（json=...）を orjson でエンコードする AsyncClient
+
+    httpx は json= を標準の json モジュールでエンコードするため、C実装で高速な orjson に置き換えます。
+    （post / put / patch などはすべて build_request を経由するため、ここだけ差し替えれば済みます）
+    """
+
+    def build_request(self, method, url, *, json=None, headers=None, **kwargs):
+        if json is not None:
+            kwargs["content"] = orjson.dumps(json)
+            headers = Headers(headers)
+            headers.setdefault("content-type", "application/json")
+        return super().build_request(method, url, headers=headers, **kwargs)
+
+@pytest.fixture(scope="session")
+async def client():
     """
     【テスト用HTTPクライアント】
     実際のHTTPリクエストを送る代わりに、アプリ内の処理を直接呼び出すクライアントです。
     これを使って `await client.post(...)` のようにAPIをテストできます。
+    テストセッション全体で1つのクライアントを共有します。
+
+    ASGITransport はアプリの起動・終了処理（lifespan）を実行しないため、
+    本番と同じ状態でテストできるよう、セッションの最初と最後に1回ずつ lifespan を実行します。
     """
-    # FastAPIの get_db を、テスト用のDBセッションを使うように強制的に上書き (Override) します
-    app.dependency_overrides[get_db] = override_get_db
-    
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://test") as c:
-        yield c
-    
-    # テストが終わったら上書きを解除して元に戻します
-    app.dependency_overrides.clear()
+    async with app.router.lifespan_context(app):
+        transport = ASGITransport(app=app)
+        async with OrClient(transport=transport, base_url="http://test") as c:
+            yield c
@@ -1,24 +1,47 @@
+import itertools
+from datetime import timedelta
+
 import pytest
-from app import schemas
+from jose import JWTError, jwt
+
+from app import auth, crud, schemas
+
+# テスト対象のエンドポイント
+REGISTER_URL = "/auth/register"
+LOGIN_URL = "/auth/login"
+
+# テストで登録するメールアドレスの連番（同じテストセッション内で重複しないようにする）
+_EMAIL_SEQ = itertools.count()
+
+
+def _email(prefix: str) -> str:
+    """テストごとに重複しないメールアドレスを作るヘルパー（例: reg-0@example.com）"""
+    return f"{prefix}-{next(_EMAIL_SEQ)}@example.com"
 
 # ----------------------------------------------------------------------
 # 認証（Auth）機能のテスト
 # ----------------------------------------------------------------------
 
 @pytest.mark.asyncio
-async def test_register_user(client):
+async def test_register_and_login(client):
     """
-    【正常系】新規ユーザー登録のテスト
-    
+    【正常系】新規ユーザー登録 → ログインのテスト
+
+    登録したユーザーでそのままログインする流れを、1つのテストでまとめて確認します。
+
     期待する動作:
     1. 正しいデータでPOSTリクエストを送ると、201 Created が返ってくること。
     2. レスポンスに、登録したメールアドレスが含まれていること。
     3. レスポンスに、セキュリティのためパスワードが含まれて *いない* こと。
+    4. 登録したメールとパスワードでログインすると、200 OK とアクセストークン (access_token) が返ってくること。
     """
-    unique_email = "test@example.com"
+    unique_email = _email("reg")
+    password = "password123"
+
+    # 1. ユーザー登録
     response = await client.post(
-        "/auth/register",
-        json={"email": unique_email, "password": "password123"},
+        REGISTER_URL,
+        json={"email": unique_email, "password": password},
     )
     # 結果の検証 (Assertion)
     assert response.status_code == 201
@@ -27,84 +50,190 @@ async def test_register_user(client):
     assert "id" in data
     assert "password" not in data
 
+    # 2. 登録したユーザーでログイン
+    response = await client.post(
+        LOGIN_URL,
+        json={"email": unique_email, "password": password},
+    )
+
+    # トークンが発行されたか確認
+    assert response.status_code == 200
+    data = response.json()
+    assert "access_token" in data
+    assert data["token_type"] == "bearer"
+
 @pytest.mark.asyncio
-async def test_register_duplicate_email(client):
+async def test_register_duplicate_email(client, seeded_users):
     """
     【異常系】メールアドレス重複のテスト
     
     期待する動作:
     1. 既に登録済みのメールアドレスで登録しようとすると、400 Bad Request エラーになること。
+    2. エラーコード（X-Error-Code ヘッダー）が EMAIL_EXISTS であること。
+    3. 2回目以降は、登録済みとして記録されたメールアドレス（crud._recent_emails）から同じエラーが返ること。
     """
-    email = "duplicate@example.com"
-    
-    # 事前準備: 1回目の登録（これは成功するはず）
-    await client.post(
-        "/auth/register",
-        json={"email": email, "password": "password123"},
-    )
+    # 事前準備: 登録済みのユーザー（seeded_users Fixture）のメールアドレスを使う
+    email = seeded_users["duplicate"]
     
-    # 検証対象: 2回目の登録（同じメールアドレス）
+    # 検証対象: 同じメールアドレスでの登録
     response = await client.post(
-        "/auth/register",
+        REGISTER_URL,
         json={"email": email, "password": "password123"},
     )
     
     # エラーになることを確認
     assert response.status_code == 400
-    assert response.json()["detail"] == "このメールアドレスは既に登録されています"
+    assert response.headers["x-error-code"] == "EMAIL_EXISTS"
+    assert email in crud._recent_emails
 
-@pytest.mark.asyncio
-async def test_login_success(client):
-    """
-    【正常系】ログイン成功のテスト
-    
-    期待する動作:
-    1. 正しいメールとパスワードを送ると、200 OK が返ってくること。
-    2. レスポンスにアクセストークン (access_token) が含まれていること。
-    """
-    email = "login@example.com"
-    password = "password123"
-    
-    # 事前準備: ユーザー登録しておく
-    await client.post(
-        "/auth/register",
-        json={"email": email, "password": password},
-    )
-    
-    # ログインリクエスト
+    # 2回目はDBに問い合わせずに同じエラーになる
     response = await client.post(
-        "/auth/login",
-        json={"email": email, "password": password},
+        REGISTER_URL,
+        json={"email": email, "password": "password123"},
     )
-    
-    # トークンが発行されたか確認
-    assert response.status_code == 200
-    data = response.json()
-    assert "access_token" in data
-    assert data["token_type"] == "bearer"
+    assert response.status_code == 400
+    assert response.headers["x-error-code"] == "EMAIL_EXISTS"
 
 @pytest.mark.asyncio
-async def test_login_failure(client):
+async def test_login_failure(client, login_user):
     """
     【異常系】ログイン失敗のテスト
     
     期待する動作:
     1. 間違ったパスワードを送ると、401 Unauthorized エラーになること。
     """
-    email = "fail@example.com"
-    password = "password123"
-    
-    # 事前準備: ユーザー登録
-    await client.post(
-        "/auth/register",
-        json={"email": email, "password": password},
-    )
+    # 事前準備: 登録済みのユーザー（login_user Fixture）を使う
+    email, _ = login_user
     
     # 間違ったパスワードでログイン試行
     response = await client.post(
-        "/auth/login",
+        LOGIN_URL,
         json={"email": email, "password": "wrongpassword"},
     )
     
     # 認証エラーを確認
     assert response.status_code == 401
+
+@pytest.mark.asyncio
+async def test_register_and_login_with_real_bcrypt(client, real_password_hasher, db_session):
+    """
+    【正常系】本物の bcrypt でのユーザー登録・ログインのテスト
+
+    他のテストではハッシュ化を簡易的な関数に差し替えているため、ここでだけ本物の bcrypt を確認します。
+
+    期待する動作:
+    1. 保存されるパスワードが bcrypt のハッシュ値になっていること（平文ではないこと）。
+    2. 正しいパスワードではログインでき、間違ったパスワードでは 401 になること。
+    """
+    email = _email("bcrypt")
+    password = "password123"
+    response = await client.post(REGISTER_URL, json={"email": email, "password": password})
+    assert response.status_code == 201
+
+    async with db_session.begin():
+        user = await crud.get_user_with_password(db_session, email=email)
+    assert user.hashed_password.startswith("$2b$")
+    assert password not in user.hashed_password
+
+    response = await client.post(LOGIN_URL, json={"email": email, "password": password})
+    assert response.status_code == 200
+    response = await client.post(LOGIN_URL, json={"email": email, "password": "wrongpassword"})
+    assert response.status_code == 401
+
+@pytest.mark.asyncio
+async def test_legacy_token_without_uid(client, login_user):
+    """
+    【正常系】uid を含まない（以前の形式の）トークンでの認証のテスト
+
+    期待する動作:
+    1. sub だけのトークンでも、DBからユーザーを検索して認証済みAPIを呼び出せること。
+    2. 登録されていないメールアドレスのトークンでは 401 になること。
+    """
+    email, _ = login_user
+    token = auth.create_access_token({"sub": email})
+    response = await client.get("/todos/", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+
+    token = auth.create_access_token({"sub": _email("missing")})
+    response = await client.get("/todos/", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401
+
+# ----------------------------------------------------------------------
+# JWT（アクセストークン）検証のテスト
+# ----------------------------------------------------------------------
+
+def _tamper_signature(token: str) -> str:
+    """トークンの署名部分の先頭1文字を書き換えて返すヘルパー"""
+    head, _, signature = token.rpartition(".")
+    return f"{head}.{'B' if signature[0] == 'A' else 'A'}{signature[1:]}"
+
+
+def test_decode_token_roundtrip():
+    """
+    【正常系】発行したトークンを検証できることのテスト
+
+    期待する動作:
+    1. create_access_token で発行したトークンから、sub（メールアドレス）を取り出せること。
+    2. 発行したトークンが標準的なJWTとして python-jose でも検証できること。
+    """
+    token = auth.create_access_token({"sub": "jwt@example.com"})
+    assert auth._decode_token(token) == "jwt@example.com"
+    assert jwt.decode(token, auth.SECRET_KEY, algorithms=["HS256"])["sub"] == "jwt@example.com"
+
+
+def test_verify_token_builds_user_from_claims():
+    """
+    【正常系】トークンのクレームからユーザー情報を組み立てられることのテスト
+
+    期待する動作:
+    1. uid / created_at を含むトークンからは、DBを使わずに UserOut が組み立てられること。
+    2. uid を含まない（以前の形式の）トークンでは、ユーザー情報が None になること。
+    """
+    token = auth.create_access_token(
+        {"sub": "claims@example.com", "uid": 42, "created_at": "2025-10-25T00:00:00+00:00"}
+    )
+    email, user_out = auth._verify_token(token)
+    assert email == "claims@example.com"
+    assert user_out.id == 42
+    assert user_out.email == "claims@example.com"
+    assert user_out.created_at.year == 2025
+
+    assert auth._verify_token(auth.create_access_token({"sub": "legacy@example.com"})) == (
+        "legacy@example.com",
+        None,
+    )
+
+
+@pytest.mark.parametrize(
+    "token_factory",
+    [
+        # 署名を改ざんしたトークン（署名の先頭1文字を別の文字に置き換える）
+        lambda: _tamper_signature(auth.create_access_token({"sub": "jwt@example.com"})),
+        # ペイロードを別のユーザーに差し替えたトークン（署名は元のまま）
+        lambda: ".".join(
+            [
+                auth.create_access_token({"sub": "other@example.com"}).split(".")[0],
+                auth.create_access_token({"sub": "other@example.com"}).split(".")[1],
+                auth.create_access_token({"sub": "jwt@example.com"}).split(".")[2],
+            ]
+        ),
+        # 期限切れのトークン
+        lambda: auth.create_access_token({"sub": "jwt@example.com"}, expires_delta=timedelta(seconds=-1)),
+        # 別の秘密鍵で署名されたトークン
+        lambda: jwt.encode({"sub": "jwt@example.com", "exp": 4102444800}, "another-secret", algorithm="HS256"),
+        # HS256以外のアルゴリズムを指定したトークン
+        lambda: jwt.encode({"sub": "jwt@example.com", "exp": 4102444800}, auth.SECRET_KEY, algorithm="HS512"),
+        # 形式が不正なトークン
+        lambda: "not-a-jwt",
+    ],
+    ids=["tampered-signature", "swapped-payload", "expired", "wrong-key", "wrong-alg", "malformed"],
+)
+def test_decode_token_rejects_invalid_tokens(token_factory):
+    """
+    【異常系】不正なトークンが拒否されることのテスト
+
+    期待する動作:
+    1. 改ざん・期限切れ・鍵やアルゴリズムの違うトークンでは JWTError が発生すること。
+    """
+    with pytest.raises(JWTError):
+        auth._decode_token(token_factory())
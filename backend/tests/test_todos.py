@@ -0,0 +1,225 @@
+import pytest
+
+from app import cache
+from app.routers import todos
+
+# ----------------------------------------------------------------------
+# ToDo 機能のテスト
+# ----------------------------------------------------------------------
+
+# ユーザー登録・ログインのエンドポイント（_auth_headers で使用）
+REGISTER_URL = "/auth/register"
+LOGIN_URL = "/auth/login"
+
+
+async def _auth_headers(client, email: str) -> dict:
+    """テスト用ユーザーを登録・ログインし、Authorizationヘッダーを返すヘルパー"""
+    password = "password123"
+    await client.post(REGISTER_URL, json={"email": email, "password": password})
+    response = await client.post(LOGIN_URL, json={"email": email, "password": password})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.mark.asyncio
+async def test_create_and_read_todos(client):
+    """
+    【正常系】ToDoの作成と一覧取得のテスト
+
+    期待する動作:
+    1. 作成したToDoが201 Createdで返ってくること。
+    2. 一覧取得で、作成したToDoが返ってくること。
+    """
+    headers = await _auth_headers(client, "todo-read@example.com")
+
+    response = await client.post("/todos/", json={"title": "牛乳を買う"}, headers=headers)
+    assert response.status_code == 201
+    created = response.json()
+    assert created["title"] == "牛乳を買う"
+    assert created["completed"] is False
+
+    response = await client.get("/todos/", headers=headers)
+    assert response.status_code == 200
+    assert [t["id"] for t in response.json()] == [created["id"]]
+
+
+@pytest.mark.asyncio
+async def test_update_and_delete_todo(client):
+    """
+    【正常系】ToDoの更新・削除のテスト
+
+    期待する動作:
+    1. PATCHで指定したフィールドだけが更新されること。
+    2. 空のPATCHでは何も変わらずにToDoが返ってくること。
+    3. 削除後は同じIDの更新・削除が404になること。
+    """
+    headers = await _auth_headers(client, "todo-update@example.com")
+    todo = (await client.post("/todos/", json={"title": "原稿を書く"}, headers=headers)).json()
+
+    response = await client.patch(f"/todos/{todo['id']}", json={"completed": True}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["completed"] is True
+    assert response.json()["title"] == "原稿を書く"
+
+    response = await client.patch(f"/todos/{todo['id']}", json={}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["completed"] is True
+
+    response = await client.delete(f"/todos/{todo['id']}", headers=headers)
+    assert response.status_code == 200
+
+    response = await client.patch(f"/todos/{todo['id']}", json={"completed": False}, headers=headers)
+    assert response.status_code == 404
+    response = await client.delete(f"/todos/{todo['id']}", headers=headers)
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_reorder_todos(client):
+    """
+    【正常系】ToDoの並び替えのテスト
+
+    期待する動作:
+    1. 送ったIDの順番どおりに一覧の並び順が更新されること。
+    """
+    headers = await _auth_headers(client, "todo-reorder@example.com")
+    ids = []
+    for title in ("A", "B", "C"):
+        ids.append((await client.post("/todos/", json={"title": title}, headers=headers)).json()["id"])
+
+    response = await client.post("/todos/reorder", json={"todo_ids": ids[::-1]}, headers=headers)
+    assert response.status_code == 200
+
+    response = await client.get("/todos/", headers=headers)
+    assert [t["id"] for t in response.json()] == ids[::-1]
+    assert [t["order"] for t in response.json()] == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_todos_are_isolated_per_user(client):
+    """
+    【異常系】他のユーザーのToDoにはアクセスできないことのテスト
+
+    期待する動作:
+    1. 他人のToDoの更新・削除は404になること。
+    2. 他人のToDoのIDを並び替えに含めても、そのToDoは変更されないこと。
+    """
+    owner = await _auth_headers(client, "todo-owner@example.com")
+    other = await _auth_headers(client, "todo-other@example.com")
+    todo = (await client.post("/todos/", json={"title": "秘密のタスク"}, headers=owner)).json()
+
+    response = await client.patch(f"/todos/{todo['id']}", json={"title": "乗っ取り"}, headers=other)
+    assert response.status_code == 404
+    response = await client.delete(f"/todos/{todo['id']}", headers=other)
+    assert response.status_code == 404
+
+    await client.post("/todos/reorder", json={"todo_ids": [999, todo["id"]]}, headers=other)
+    response = await client.get("/todos/", headers=owner)
+    assert response.json()[0]["title"] == "秘密のタスク"
+    assert response.json()[0]["order"] == 0
+
+
+@pytest.mark.asyncio
+async def test_todos_require_authentication(client):
+    """
+    【異常系】トークンなし・不正なトークンでのアクセスのテスト
+
+    期待する動作:
+    1. トークンなし、または不正なトークンでは401 Unauthorizedになること。
+    """
+    response = await client.get("/todos/")
+    assert response.status_code == 401
+
+    response = await client.get("/todos/", headers={"Authorization": "Bearer invalid.token.value"})
+    assert response.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_read_todos_etag(client):
+    """
+    【正常系】ToDo一覧の ETag / If-None-Match のテスト
+
+    期待する動作:
+    1. 一覧のレスポンスに ETag ヘッダーが付いていること。
+    2. 同じ ETag を If-None-Match で送ると、本文なしの 304 Not Modified が返ってくること。
+    3. ToDoを追加すると ETag が変わり、古い ETag では 200 OK が返ってくること。
+    """
+    headers = await _auth_headers(client, "todo-etag@example.com")
+    await client.post("/todos/", json={"title": "A"}, headers=headers)
+
+    response = await client.get("/todos/", headers=headers)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    response = await client.get("/todos/", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+    await client.post("/todos/", json={"title": "B"}, headers=headers)
+    response = await client.get("/todos/", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert len(response.json()) == 2
+
+
+@pytest.fixture
+def fake_cache(monkeypatch, db_session):
+    """
+    Redis の代わりに辞書を使うキャッシュ（このテストの間だけ）
+
+    cache_get / cache_set / cache_delete を辞書の読み書きに差し替え、
+    キャッシュにヒットした場合や、書き込み後に無効化される場合の動作を確認できるようにします。
+    削除が呼ばれた時点でトランザクションが終わっていたか（コミット後か）も記録します。
+    """
+    store: dict[str, bytes] = {}
+    deletes_in_transaction: list[bool] = []
+
+    async def _get(key):
+        return store.get(key)
+
+    async def _set(key, value, ttl_seconds):
+        store[key] = value
+
+    async def _delete(*keys):
+        deletes_in_transaction.append(db_session.in_transaction())
+        for key in keys:
+            store.pop(key, None)
+
+    monkeypatch.setattr(todos, "cache_get", _get)
+    monkeypatch.setattr(todos, "cache_set", _set)
+    monkeypatch.setattr(cache, "cache_delete", _delete)
+    return store, deletes_in_transaction
+
+
+@pytest.mark.asyncio
+async def test_read_todos_cache(client, fake_cache):
+    """
+    【正常系】ToDo一覧のキャッシュのテスト
+
+    期待する動作:
+    1. 一覧を取得すると、「ETag + 空白 + JSON」がキャッシュに保存されること。
+    2. キャッシュがあれば、DBではなくキャッシュの内容（ETag と JSON）が返ってくること。
+    3. ToDoを追加すると、コミットの後にキャッシュが削除され、次の取得で新しい一覧が返ってくること。
+    """
+    store, deletes_in_transaction = fake_cache
+    headers = await _auth_headers(client, "todo-cache@example.com")
+    await client.post("/todos/", json={"title": "A"}, headers=headers)
+    assert deletes_in_transaction == [False]
+
+    response = await client.get("/todos/", headers=headers)
+    assert response.status_code == 200
+    (key,) = store
+    assert store[key] == response.headers["etag"].encode() + b" " + response.content
+
+    # キャッシュの内容を書き換え、DBではなくキャッシュから返されることを確認
+    store[key] = b'W/"cached" [{"id": 0}]'
+    response = await client.get("/todos/", headers=headers)
+    assert response.headers["etag"] == 'W/"cached"'
+    assert response.content == b'[{"id": 0}]'
+
+    await client.post("/todos/", json={"title": "B"}, headers=headers)
+    assert key not in store
+    assert deletes_in_transaction == [False, False]
+
+    response = await client.get("/todos/", headers=headers)
+    assert [todo["title"] for todo in response.json()] == ["A", "B"]